@@ -0,0 +1,218 @@
+import gc
+import os
+import sys
+import time
+import resource
+import subprocess
+import linkpath
+from linkpath import dump_triples, load_triples, AggregatingGraph, LinkPathProcessor, Node, RDFLibStore, CompactStore
+from rdflib import Graph, Namespace, URIRef, Literal, RDF
+from rdflib.parser import StringInputSource
+
+
+def timed(fn, repeat=3):
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def make_foaf_data(people):
+  lines = [
+    "@prefix foaf: <http://xmlns.com/foaf/0.1/> .",
+    "@prefix res: <http://example.com/res/> .",
+  ]
+  for i in range(people):
+    lines.append('res:person%s a foaf:Person ; foaf:givenName "Given%s" ; foaf:familyName "Family%s" ; foaf:age "%s" ; foaf:knows res:person%s, res:person%s .'
+      % (i, i, i, 18 + i % 60, (i + 1) % people, (i * 7) % people))
+  return "\n".join(lines)
+
+
+def bench_snapshot(people):
+  turtle = make_foaf_data(people)
+  d = Graph()
+  d.parse(StringInputSource(turtle), format="n3")
+  rdfxml = d.serialize(format="xml")
+  snapshot = dump_triples(d)
+
+  def parse_turtle():
+    Graph().parse(StringInputSource(turtle), format="n3")
+
+  def parse_rdfxml():
+    Graph().parse(StringInputSource(rdfxml), format="xml")
+
+  def decode_snapshot():
+    load_triples(snapshot)
+
+  def load_snapshot():
+    g = Graph()
+    g.addN((s, p, o, g) for (s, p, o) in load_triples(snapshot))
+
+  print "Snapshot: %s triples, turtle %s bytes, rdf/xml %s bytes, snapshot %s bytes" % (len(d), len(turtle), len(rdfxml), len(snapshot))
+  turtle_time = timed(parse_turtle)
+  rdfxml_time = timed(parse_rdfxml)
+  decode_time = timed(decode_snapshot)
+  snapshot_time = timed(load_snapshot)
+  print "  parse turtle   %.3fs" % turtle_time
+  print "  parse rdf/xml  %.3fs" % rdfxml_time
+  print "  decode snapshot %.3fs (adding the triples to a graph is the rest of the load time)" % decode_time
+  print "  load snapshot  %.3fs (%.1fx faster than turtle, %.1fx faster than rdf/xml)" % (snapshot_time, turtle_time / snapshot_time, rdfxml_time / snapshot_time)
+
+
+def make_fanout_processor(people):
+  # urn: uris are never looked up, so the whole query runs against local data
+  g = AggregatingGraph()
+  d = Graph()
+  d.parse(StringInputSource(make_foaf_data(people).replace("http://example.com/res/", "urn:res:")), format="n3")
+  hub = URIRef("urn:res:hub")
+  g.add_triples((hub, URIRef("http://xmlns.com/foaf/0.1/knows"), s) for s in set(d.subjects()))
+  g.add_triples(d)
+  wp = LinkPathProcessor(g)
+  wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+  return (wp, hub)
+
+
+def bench_fanout(people):
+  (wp, hub) = make_fanout_processor(people)
+  path = "foaf:knows/foaf:Person[foaf:age/text() > 40]/foaf:givenName/text()"
+
+  def select_each():
+    # the uncompiled path matches one candidate at a time
+    parsed = wp.parse_path(path)
+    return parsed.select(Node(hub, wp.g).get_arcs(), wp.g, None)
+
+  def select_frontier():
+    return wp.select(str(hub), path)
+
+  assert set(r.value for r in select_each()) == set(select_frontier())
+  print "Fanout: %s people known by one resource, %s results" % (people, len(select_frontier()))
+  each_time = timed(select_each)
+  frontier_time = timed(select_frontier)
+  print "  one candidate at a time  %.3fs" % each_time
+  print "  whole frontier at a time %.3fs (%.1fx faster)" % (frontier_time, each_time / frontier_time)
+
+
+def bench_vector(sizes):
+  # Compare a frontier of people's ages with a number one at a time and with
+  # numpy, to find how large a frontier has to be for numpy to be faster
+  if linkpath.numpy is None:
+    print "Vector: numpy is not installed"
+    return
+
+  wp = LinkPathProcessor(AggregatingGraph())
+  wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+  expr = wp.parse_path("*[foaf:age/text() >= 32]").steps[0].filters[0].operands[0].operands[0]
+  numpy = linkpath.numpy
+  print "Vector: comparing ages with a number, %s values at a time with numpy by default" % linkpath.VECTOR_THRESHOLD
+  for size in sizes:
+    ages = [[Node(Literal(str(18 + i % 60)), wp.g)] for i in range(size)]
+    numbers = [32.0] * size
+    repeat = max(1, 100000 / size)
+
+    def compare():
+      for i in range(repeat):
+        expr.compare_lists_to_numerics(ages, numbers)
+
+    try:
+      linkpath.numpy = None
+      scalar_time = timed(compare)
+      linkpath.numpy = numpy
+      threshold = linkpath.VECTOR_THRESHOLD
+      linkpath.VECTOR_THRESHOLD = 0
+      vector_time = timed(compare)
+    finally:
+      linkpath.numpy = numpy
+      linkpath.VECTOR_THRESHOLD = threshold
+    print "  %6s values  scalar %.2fus  numpy %.2fus per value (%.1fx)" % (size, scalar_time * 1e6 / (size * repeat), vector_time * 1e6 / (size * repeat), scalar_time / vector_time)
+
+
+def add_triples(store, triples):
+  graph = Graph(store=store)
+  store.addN((s, p, o, graph) for (s, p, o) in triples)
+
+
+def foaf_triples(people):
+  # The triples of make_foaf_data, built directly so that no parsed graph is
+  # freed before a store's memory is measured
+  foaf = Namespace("http://xmlns.com/foaf/0.1/")
+  res = Namespace("http://example.com/res/")
+  triples = []
+  for i in range(people):
+    person = res["person%s" % i]
+    triples.extend([(person, RDF.type, foaf.Person), (person, foaf.givenName, Literal("Given%s" % i)),
+      (person, foaf.familyName, Literal("Family%s" % i)), (person, foaf.age, Literal(str(18 + i % 60)))])
+    for j in set([(i + 1) % people, (i * 7) % people]):
+      triples.append((person, foaf.knows, res["person%s" % j]))
+  return triples
+
+
+def current_memory():
+  # The resident memory of this process in bytes, from /proc on Linux
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def store_growth(name, people):
+  # The growth in resident memory from adding the triples to a new store
+  triples = foaf_triples(people)
+  gc.collect()
+  before = current_memory()
+  store = getattr(linkpath, name)()
+  add_triples(store, triples)
+  gc.collect()
+  return current_memory() - before
+
+
+def store_memory(make_store, people):
+  # Measured in a fresh interpreter so each store starts from the same point
+  # and memory freed by earlier benchmarks is not reused
+  output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "store-memory", make_store.__name__, str(people)])
+  return int(output)
+
+
+def bench_store(people):
+  triples = foaf_triples(people)
+  subjects = list(set(s for (s, p, o) in triples))
+  knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+  print "Store: %s triples, %s subjects" % (len(triples), len(subjects))
+  for make_store in (RDFLibStore, CompactStore):
+    store = make_store()
+
+    def add():
+      add_triples(make_store(), triples)
+
+    def query():
+      for s in subjects:
+        for p in store.predicates(s):
+          store.objects(s, p)
+        store.subjects(knows, s)
+
+    def contains():
+      for triple in triples:
+        assert triple in store
+
+    add_time = timed(add)
+    add_triples(store, triples)
+    query_time = timed(query)
+    contains_time = timed(contains)
+    used = store_memory(make_store, people)
+    print "  %-12s add %.3fs  query %.3fs  contains %.3fs  memory %.1fMB (%s bytes a triple)" % (make_store.__name__, add_time, query_time, contains_time, used / 1048576.0, used / len(triples))
+
+
+if __name__ == "__main__":
+  if sys.argv[1:2] == ["store-memory"]:
+    print store_growth(sys.argv[2], int(sys.argv[3]))
+    sys.exit(0)
+  people = 5000
+  if len(sys.argv) > 1:
+    people = int(sys.argv[1])
+  bench_snapshot(people)
+  # every foaf:knows arc of the hub leads to every person, so the frontier
+  # grows with the square of the number of people
+  bench_fanout(people / 25)
+  bench_vector([1, 4, 16, 64, 256, 1024, 16384])
+  bench_store(people * 4)
@@ -1,12 +1,39 @@
-__all__ = ["LinkPathProcessor", "AggregatingGraph", "ParseError", "EvaluationError"]
+__all__ = ["LinkPathProcessor", "AggregatingGraph", "RDFLibStore", "CompactStore", "DocumentCache", "FetchScheduler", "NegativeCache", "FetchArchive", "Results", "ParseError", "EvaluationError"]
 
 import rdflib
 import httplib2
 import re
+import os
 import sys
+import time
+import hashlib
+import json
+import urlparse
+import urllib2
+import httplib
+import socket
+import xml.sax
+import threading
+import Queue
+import marshal
+import math
+import struct
+import gzip
+from array import array
+from collections import OrderedDict
+from itertools import izip
 from rdflib import RDF, URIRef, Literal, BNode
 from rdflib.parser import StringInputSource
+from rdflib.store import Store, TripleAddedEvent, TripleRemovedEvent
+from rdflib.plugins.memory import IOMemory
 from rdflib.plugins.parsers.notation3 import BadSyntax
+from rdflib.plugins.parsers.ntriples import NTriplesParser, ParseError as NTriplesParseError, r_wspace, r_tail
+from rdflib.plugins.parsers.rdfxml import RDFXMLHandler, ErrorHandler as RDFXMLErrorHandler
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 def isnumeric(s):
   try:
@@ -16,19 +43,996 @@ def isnumeric(s):
   return True
 
 
+ACCEPT = "text/turtle, application/rdf+xml;q=0.9, application/xml;q=0.1, text/xml;q=0.1"
+SNAPSHOT_VERSION = 1
+# The estimated cost of looking up a frontier of resources, relative to
+# testing a resource that is already in the graph
+LOOKUP_COST = 100
+# The kind of each type of value an expression can evaluate to, used to pick
+# how two values are compared
+KINDS = {list: 'set', bool: 'boolean', int: 'number', float: 'number', str: 'string', unicode: 'string'}
+# Numeric comparisons over at least this many values at once are made with
+# numpy arrays when numpy is installed
+VECTOR_THRESHOLD = 64
+# A repeated step such as foaf:knows+ follows arcs at most this many times
+# and expands at most this many nodes from each starting resource
+MAX_CLOSURE_DEPTH = 32
+MAX_CLOSURE_NODES = 10000
+STREAM_ACCEPT = "application/n-triples, application/n-quads;q=0.9, text/turtle;q=0.8, application/rdf+xml;q=0.8, text/plain;q=0.5, application/xml;q=0.1, text/xml;q=0.1"
+STREAM_LINE_TYPES = ['application/n-triples', 'application/n-quads', 'text/x-nquads', 'text/plain']
+STREAM_XML_TYPES = ['application/rdf+xml', 'application/xml', 'text/xml']
+
+def compile_many(expr, g):
+  # Returns a function of (groups, contexts) that evaluates expr without
+  # tracing against each group of resources, returning a list of values.
+  # Expressions without their own compile_many method are evaluated once per
+  # group, after compiling any paths among their arguments.
+  if hasattr(expr, 'compile_many'):
+    return expr.compile_many(g)
+  for name in ('arg', 'arg1', 'arg2'):
+    if hasattr(expr, name):
+      compile_many(getattr(expr, name), g)
+  for arg in getattr(expr, 'args', []):
+    compile_many(arg, g)
+  return lambda groups, contexts: [expr.evaluate(value, g, context, False) for (value, context) in izip(groups, contexts)]
+
+
+def estimate_cost(expr):
+  # A rough estimate of the cost of evaluating expr, used to test cheap
+  # filters before ones that have to look up resources. Expressions without
+  # their own cost method cost one more than their arguments.
+  if hasattr(expr, 'cost'):
+    return expr.cost()
+  cost = 1
+  for name in ('arg', 'arg1', 'arg2'):
+    if hasattr(expr, name):
+      cost += estimate_cost(getattr(expr, name))
+  for arg in getattr(expr, 'args', []):
+    cost += estimate_cost(arg)
+  return cost
+
+
+def needs_data(expr):
+  # Whether evaluating expr against a resource reads what the resource leads
+  # to, as a path does, rather than only the resource itself, as uri(.) does.
+  # Expressions without their own needs_data method need it if any of their
+  # arguments do.
+  if hasattr(expr, 'needs_data'):
+    return expr.needs_data()
+  for name in ('arg', 'arg1', 'arg2'):
+    if hasattr(expr, name) and needs_data(getattr(expr, name)):
+      return True
+  return any(needs_data(arg) for arg in getattr(expr, 'args', []))
+
+
+def compile_select(step, g):
+  # Returns a function of (candidates, tags) that returns the candidates that
+  # match step and the tag of each. Repeated steps return every arc reached
+  # by repeating them.
+  if getattr(step, 'repeat', None) is not None:
+    return step.compile_closure(g)
+  match = step.compile(g)
+  def select(candidates, tags):
+    mask = match(candidates)
+    return ([c for (c, matched) in izip(candidates, mask) if matched], [t for (t, matched) in izip(tags, mask) if matched])
+  return select
+
+
+def is_inbound(step):
+  # Whether the arcs step matches are the ones pointing to a node. Steps that
+  # are plain matchers, such as text(), have no axis.
+  return getattr(step, 'axis', None) == 'in'
+
+
+def location_key(location):
+  # Resources with the same key match the same steps and filters
+  if location.is_arc():
+    return (Arc, location.node, location.value, location.inverse)
+  value = location.value
+  return (value.__class__, unicode(value), getattr(value, 'datatype', None), getattr(value, 'language', None))
+
+
+def expand(resources, g, distinct = False, prefetch = False, predicates = None, inbound = False):
+  # Returns the list of resources one step on from each of resources: the
+  # values of an arc or the arcs of a node. The graph is queried once for the
+  # whole list. If predicates is a set only arcs for those predicates are
+  # returned. If inbound is true the arcs of a node are the ones pointing to
+  # it, for a step on the in:: axis, and their values are their subjects.
+  arcs = []
+  inverse_arcs = []
+  nodes = []
+  for i in xrange(len(resources)):
+    resource = resources[i]
+    if resource.is_literal():
+      continue
+    if resource.is_arc():
+      if resource.inverse:
+        inverse_arcs.append(i)
+      else:
+        arcs.append(i)
+    else:
+      nodes.append(i)
+
+  children = [[] for resource in resources]
+  if len(arcs) > 0:
+    values = g.get_subjects_property_values([(resources[i].node, resources[i].value) for i in arcs])
+    for (i, objects) in izip(arcs, values):
+      children[i] = [Node(o, g) for o in objects]
+  if len(inverse_arcs) > 0:
+    values = g.get_objects_property_subjects([(resources[i].node, resources[i].value) for i in inverse_arcs])
+    for (i, subjects) in izip(inverse_arcs, values):
+      children[i] = [Node(s, g) for s in subjects]
+  if len(nodes) > 0:
+    if inbound:
+      properties = g.get_objects_properties([resources[i].value for i in nodes], distinct, predicates)
+    else:
+      properties = g.get_subjects_properties([resources[i].value for i in nodes], distinct, predicates)
+    for (i, props) in izip(nodes, properties):
+      children[i] = [Arc(p, resources[i].value, g, inbound) for p in props]
+
+  if prefetch:
+    # look up every node in the frontier at once rather than one by one as
+    # each is matched
+    uris = [n.value for i in arcs + inverse_arcs for n in children[i] if n.is_uri()]
+    if len(uris) > 0:
+      g.lookup_many(uris)
+
+  return children
+
+
+def dump_triples(triples):
+  # Encode triples as a table of distinct terms and an array of three term
+  # indexes per triple. The result can be loaded much faster than the document
+  # the triples were parsed from.
+  terms = []
+  ids = {}
+  triple_ids = array('i')
+  for triple in triples:
+    for term in triple:
+      i = ids.get(term)
+      if i is None:
+        i = len(terms)
+        ids[term] = i
+        if isinstance(term, Literal):
+          dt = term.datatype
+          if dt is not None:
+            dt = unicode(dt)
+          terms.append((2, unicode(term), term.language, dt))
+        elif isinstance(term, BNode):
+          terms.append((1, unicode(term)))
+        else:
+          terms.append((0, unicode(term)))
+      triple_ids.append(i)
+  return marshal.dumps((SNAPSHOT_VERSION, terms, triple_ids.tostring()))
+
+def load_triples(data):
+  (version, terms, triple_string) = marshal.loads(data)
+  if version != SNAPSHOT_VERSION:
+    raise ValueError("Unsupported triple snapshot version %s" % version)
+  nodes = []
+  for term in terms:
+    if term[0] == 0:
+      nodes.append(URIRef(term[1]))
+    elif term[0] == 1:
+      nodes.append(BNode(term[1]))
+    else:
+      nodes.append(Literal(term[1], lang=term[2], datatype=term[3]))
+  triple_ids = array('i')
+  triple_ids.fromstring(triple_string)
+  return [(nodes[triple_ids[i]], nodes[triple_ids[i + 1]], nodes[triple_ids[i + 2]]) for i in xrange(0, len(triple_ids), 3)]
+
+# Errors that mean a triple snapshot is from another SNAPSHOT_VERSION or is
+# damaged
+SNAPSHOT_ERRORS = (ValueError, EOFError, TypeError, IndexError)
+
+
+class TripleSink:
+  # Receives triples from a streaming parser and adds them to an
+  # AggregatingGraph a batch at a time
+  def __init__(self, graph, batch_size=1000):
+    self.graph = graph
+    self.batch_size = batch_size
+    self.triples = []
+
+  def triple(self, s, p, o):
+    self.add((s, p, o))
+
+  def add(self, triple):
+    self.triples.append(triple)
+    if len(self.triples) >= self.batch_size:
+      self.flush()
+
+  def bind(self, prefix, namespace, override=True):
+    pass
+
+  def flush(self):
+    if len(self.triples) > 0:
+      self.graph.add_triples(self.triples)
+      self.triples = []
+
+
+class LineParser(NTriplesParser):
+  # Parses N-Triples or N-Quads a line at a time, discarding the graph name
+  # of any quads
+  def parseline(self):
+    self.eat(r_wspace)
+    if (not self.line) or self.line.startswith('#'):
+      return
+
+    subject = self.subject()
+    self.eat(r_wspace)
+    predicate = self.predicate()
+    self.eat(r_wspace)
+    object = self.object()
+    self.eat(r_wspace)
+    if self.peek('<'):
+      self.uriref()
+    elif self.peek('_'):
+      self.nodeid()
+    self.eat(r_tail)
+
+    if self.line:
+      raise NTriplesParseError("Trailing garbage")
+    self.sink.triple(subject, predicate, object)
+
+
+class StreamLocator:
+  # Reports the document uri as the base for RDF/XML fed to the parser in
+  # chunks, which otherwise has no system id, and the parser's position
+  def __init__(self, uri, locator):
+    self.uri = uri
+    self.locator = locator
+
+  def getSystemId(self):
+    return self.uri
+
+  def getPublicId(self):
+    return None
+
+  def getLineNumber(self):
+    return self.locator.getLineNumber()
+
+  def getColumnNumber(self):
+    return self.locator.getColumnNumber()
+
+
+class StreamRDFXMLHandler(RDFXMLHandler):
+  def __init__(self, store, uri, parser):
+    self.uri = uri
+    RDFXMLHandler.__init__(self, store)
+    # expat only sets the locator itself when parsing a whole document
+    self.setDocumentLocator(parser)
+
+  def setDocumentLocator(self, locator):
+    RDFXMLHandler.setDocumentLocator(self, StreamLocator(self.uri, locator))
+
+
+# Errors that mean a document could not be fetched
+FETCH_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error, urllib2.URLError)
+
+def is_timeout(error):
+  # Whether a fetch failed because it ran out of time rather than because the
+  # host or document failed
+  if isinstance(error, urllib2.URLError):
+    error = error.reason
+  return isinstance(error, socket.timeout)
+
+
+class CountingReader:
+  def __init__(self, f):
+    self.f = f
+    self.count = 0
+
+  def read(self, n=-1):
+    data = self.f.read(n)
+    self.count += len(data)
+    return data
+
+
+class QueryLimits:
+  # Limits on the fetching done by one query. Once a limit is reached no more
+  # documents are fetched and the query is marked as incomplete.
+  def __init__(self, max_documents=None, max_bytes=None, timeout=None, deadline=None):
+    self.max_documents = max_documents
+    self.max_bytes = max_bytes
+    self.timeout = timeout
+    self.deadline = None
+    if deadline is not None:
+      self.deadline = time.time() + deadline
+    self.documents = 0
+    self.bytes = 0
+    self.complete = True
+    self.lock = threading.Lock()
+
+  def allow(self):
+    # Reserve a document from the budget, returning False if there is none left
+    with self.lock:
+      if (self.max_documents is not None and self.documents >= self.max_documents) \
+         or (self.max_bytes is not None and self.bytes >= self.max_bytes) \
+         or (self.deadline is not None and time.time() >= self.deadline):
+        self.complete = False
+        return False
+      self.documents += 1
+      return True
+
+  def record(self, size):
+    with self.lock:
+      self.bytes += size
+
+  def request_timeout(self):
+    timeout = self.timeout
+    if self.deadline is not None:
+      remaining = max(self.deadline - time.time(), 0.001)
+      if timeout is None or remaining < timeout:
+        timeout = remaining
+    return timeout
+
+
+class FilterMemo:
+  # The results of filters tested during one query, keyed by the filter
+  # expression and the resource it was tested against. truncated is set when
+  # a repeated step in the query is cut short by the closure limits.
+  def __init__(self):
+    self.results = {}
+    self.hits = 0
+    self.misses = 0
+    self.truncated = False
+
+  def get(self, expr, location):
+    # Returns the remembered result, or None if the filter has not been tested
+    # against location yet
+    value = self.results.get((expr, location_key(location)))
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+  def put(self, expr, location, value):
+    self.results[(expr, location_key(location))] = value
+
+
+def make_limits(max_documents=None, max_bytes=None, timeout=None, deadline=None):
+  # The limits for a query, or None if it has none
+  if max_documents is not None or max_bytes is not None or timeout is not None or deadline is not None:
+    return QueryLimits(max_documents, max_bytes, timeout, deadline)
+  return None
+
+
+class Results(list):
+  # The values selected by a query. complete is False when the query stopped
+  # fetching documents because it reached one of its limits. memo_hits and
+  # memo_misses count the filter tests answered from, and added to, the
+  # query's memo.
+  def __init__(self, values=[], complete=True, memo_hits=0, memo_misses=0):
+    list.__init__(self, values)
+    self.complete = complete
+    self.memo_hits = memo_hits
+    self.memo_misses = memo_misses
+
+
 class ParseError(Exception):
   pass
 
 class EvaluationError(Exception):
   pass
 
+class DocumentCache:
+  # Stores fetched documents on disk, one metadata file and one body file per
+  # document, named after the sha1 of the document's uri. The modification time
+  # of the metadata file records when the document was last used, and the least
+  # recently used documents are removed once the bodies exceed max_size bytes.
+  def __init__(self, path, ttl=3600, max_size=100*1024*1024):
+    self.path = path
+    self.ttl = ttl
+    self.max_size = max_size
+    self.size = None
+    self.lock = threading.RLock()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+  def filename(self, uri, ext):
+    return os.path.join(self.path, "%s.%s" % (hashlib.sha1(uri).hexdigest(), ext))
+
+  def get(self, uri):
+    with self.lock:
+      try:
+        f = open(self.filename(uri, 'json'), 'rb')
+        try:
+          entry = json.load(f)
+        finally:
+          f.close()
+        os.utime(self.filename(uri, 'json'), None)
+      except (IOError, OSError, ValueError):
+        return None
+    if entry.get('uri') != uri:
+      return None
+    return entry
+
+  def is_fresh(self, entry):
+    return time.time() - entry['fetched'] < self.ttl
+
+  def load(self, uri, entry):
+    with self.lock:
+      try:
+        f = open(self.filename(uri, 'body'), 'rb')
+        try:
+          body = f.read()
+        finally:
+          f.close()
+      except IOError:
+        return None
+    info = {'status' : 200, 'content-type' : entry['content-type']}
+    for header in ('etag', 'last-modified'):
+      if entry.get(header):
+        info[header] = entry[header]
+    response = httplib2.Response(info)
+    response.fromcache = True
+    return (response, body)
+
+  def put(self, uri, response, body):
+    entry = {
+      'uri' : uri,
+      'content-type' : response.get('content-type', ''),
+      'etag' : response.get('etag'),
+      'last-modified' : response.get('last-modified'),
+      'fetched' : time.time(),
+      'size' : len(body),
+    }
+    with self.lock:
+      old = self.get(uri)
+      self.remove(self.filename(uri, 'triples'))
+      self.write(self.filename(uri, 'body'), body)
+      self.write(self.filename(uri, 'json'), json.dumps(entry))
+      if self.size is not None:
+        self.size += entry['size']
+        if old is not None:
+          self.size -= old.get('size', 0)
+      if self.size is None or self.size > self.max_size:
+        self.evict()
+
+  def load_snapshot(self, uri):
+    with self.lock:
+      try:
+        f = open(self.filename(uri, 'triples'), 'rb')
+        try:
+          return f.read()
+        finally:
+          f.close()
+      except IOError:
+        return None
+
+  def put_snapshot(self, uri, data):
+    with self.lock:
+      self.write(self.filename(uri, 'triples'), data)
+      if self.size is not None:
+        self.size += len(data)
+
+  def remove_snapshot(self, uri):
+    with self.lock:
+      filename = self.filename(uri, 'triples')
+      if self.size is not None:
+        try:
+          self.size -= os.path.getsize(filename)
+        except OSError:
+          pass
+      self.remove(filename)
+
+  def refresh(self, uri, entry):
+    entry['fetched'] = time.time()
+    with self.lock:
+      self.write(self.filename(uri, 'json'), json.dumps(entry))
+
+  def write(self, filename, data):
+    tmp = "%s.%s.tmp" % (filename, threading.current_thread().ident)
+    f = open(tmp, 'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    os.rename(tmp, filename)
+
+  def remove(self, filename):
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
+
+  def evict(self):
+    with self.lock:
+      entries = []
+      self.size = 0
+      for name in os.listdir(self.path):
+        if name.endswith('.json'):
+          filename = os.path.join(self.path, name)
+          try:
+            # a document's size includes its snapshot, so evicting it frees both
+            size = os.path.getsize(filename[:-5] + '.body')
+            if os.path.exists(filename[:-5] + '.triples'):
+              size += os.path.getsize(filename[:-5] + '.triples')
+            entries.append((os.path.getmtime(filename), filename, size))
+          except OSError:
+            continue
+          self.size += size
+
+      entries.sort()
+      for (used, filename, size) in entries:
+        if self.size <= self.max_size:
+          break
+        for ext in ('.json', '.body', '.triples'):
+          self.remove(filename[:-5] + ext)
+        self.size -= size
+
+
+class NegativeCache:
+  # Remembers documents that could not be fetched or parsed, and hosts that
+  # could not be reached, so they are not retried until a backoff period has
+  # passed. The period doubles with each consecutive failure, from base_delay
+  # up to max_delay seconds. One NegativeCache can be shared by several
+  # AggregatingGraphs, and if it has a path it is kept in that file between
+  # runs.
+  def __init__(self, path=None, base_delay=60, max_delay=86400):
+    self.path = path
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.uris = {}
+    self.hosts = {}
+    self.lock = threading.RLock()
+    if path is not None and os.path.exists(path):
+      try:
+        f = open(path, 'rb')
+        try:
+          data = json.load(f)
+        finally:
+          f.close()
+        self.uris = data.get('uris', {})
+        self.hosts = data.get('hosts', {})
+      except (IOError, ValueError):
+        pass
+
+  def host(self, uri):
+    return urlparse.urlsplit(uri)[1].lower()
+
+  def is_failing(self, uri):
+    now = time.time()
+    with self.lock:
+      for entry in (self.uris.get(uri), self.hosts.get(self.host(uri))):
+        if entry is not None and now < entry['retry']:
+          return True
+    return False
+
+  def failed(self, uri, failure, status=None):
+    # failure is one of 'network', 'status', 'syntax' or 'content-type'. Only
+    # network failures count against the host as well as the document.
+    with self.lock:
+      self.uris[uri] = self.backoff(self.uris.get(uri), failure, status)
+      if failure == 'network':
+        host = self.host(uri)
+        self.hosts[host] = self.backoff(self.hosts.get(host), failure, status)
+      self.save()
+
+  def succeeded(self, uri):
+    with self.lock:
+      changed = False
+      for (entries, key) in ((self.uris, uri), (self.hosts, self.host(uri))):
+        if key in entries:
+          del entries[key]
+          changed = True
+      if changed:
+        self.save()
+
+  def backoff(self, entry, failure, status):
+    failures = 1
+    if entry is not None:
+      failures = entry['failures'] + 1
+    delay = min(self.base_delay * (2 ** (failures - 1)), self.max_delay)
+    return {'failure' : failure, 'status' : status, 'failures' : failures, 'failed' : time.time(), 'retry' : time.time() + delay}
+
+  def save(self):
+    if self.path is None:
+      return
+    with self.lock:
+      tmp = "%s.%s.tmp" % (self.path, threading.current_thread().ident)
+      f = open(tmp, 'wb')
+      try:
+        json.dump({'uris' : self.uris, 'hosts' : self.hosts}, f)
+      finally:
+        f.close()
+      os.rename(tmp, self.path)
+
+
+class FetchArchive:
+  # Records every request made by an AggregatingGraph and its response in a
+  # gzipped file of length prefixed marshalled records, or replays them from
+  # that file without using the network.
+  # When replaying, latency simulates the time each request took, either as
+  # one number of seconds for all hosts or a dict of seconds per host.
+  def __init__(self, path, mode='record', latency=None):
+    if mode not in ('record', 'replay'):
+      raise ValueError("FetchArchive mode must be 'record' or 'replay', not %s" % mode)
+    self.path = path
+    self.mode = mode
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.responses = {}
+    self.f = None
+    if mode == 'record':
+      self.f = gzip.open(path, 'ab')
+    else:
+      f = gzip.open(path, 'rb')
+      try:
+        while True:
+          size = f.read(4)
+          if len(size) < 4:
+            break
+          (uri, headers, status, response_headers, body) = marshal.loads(f.read(struct.unpack('>I', size)[0]))
+          if status == 304 and uri in self.responses:
+            # keep the full response a revalidation refers to
+            continue
+          self.responses[uri] = (status, response_headers, body)
+      finally:
+        f.close()
+
+  def is_replaying(self):
+    return self.mode == 'replay'
+
+  def record(self, uri, headers, response, body):
+    response_headers = dict((str(k), str(v)) for (k, v) in response.items())
+    data = marshal.dumps((uri, headers, response.status, response_headers, body))
+    with self.lock:
+      self.f.write(struct.pack('>I', len(data)))
+      self.f.write(data)
+      self.f.flush()
+
+  def replay(self, uri):
+    if self.latency:
+      if isinstance(self.latency, dict):
+        delay = self.latency.get(urlparse.urlsplit(uri)[1].lower(), 0)
+      else:
+        delay = self.latency
+      time.sleep(delay)
+
+    if uri not in self.responses:
+      return (httplib2.Response({'status' : 404}), '')
+    (status, response_headers, body) = self.responses[uri]
+    info = dict(response_headers)
+    info['status'] = status
+    return (httplib2.Response(info), body)
+
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+
+class FetchScheduler:
+  # Runs HTTP requests for an AggregatingGraph. Each host has a pool of
+  # httplib2 clients which keep their connections alive between requests, and
+  # requests wait until they are within the limits on connections per host,
+  # requests in flight and requests per second to each host.
+  def __init__(self, max_per_host=4, max_in_flight=32, requests_per_second=None):
+    self.max_per_host = max_per_host
+    self.max_in_flight = max_in_flight
+    self.requests_per_second = requests_per_second
+    self.condition = threading.Condition()
+    self.idle = {}
+    self.active = {}
+    self.in_flight = 0
+    self.next_start = {}
+    self.counters = {'requests' : 0, 'clients_created' : 0, 'clients_reused' : 0, 'connections_opened' : 0, 'connections_reused' : 0}
+
+  def request(self, uri, headers, timeout=None):
+    parts = urlparse.urlsplit(uri)
+    host = parts[1].lower()
+    client = self.acquire(host)
+    try:
+      key = "%s:%s" % (parts[0], parts[1])
+      if key in client.connections:
+        self.count('connections_reused')
+      else:
+        self.count('connections_opened')
+      self.set_timeout(client, timeout)
+      return client.request(uri, "GET", headers=headers)
+    finally:
+      self.release(host, client)
+
+  def acquire(self, host):
+    with self.condition:
+      while self.in_flight >= self.max_in_flight or self.active.get(host, 0) >= self.max_per_host:
+        self.condition.wait()
+      self.in_flight += 1
+      self.active[host] = self.active.get(host, 0) + 1
+      self.counters['requests'] += 1
+
+      if self.idle.get(host):
+        client = self.idle[host].pop()
+        self.counters['clients_reused'] += 1
+      else:
+        client = None
+        self.counters['clients_created'] += 1
+
+      delay = 0
+      if self.requests_per_second:
+        now = time.time()
+        start = max(now, self.next_start.get(host, now))
+        self.next_start[host] = start + 1.0 / self.requests_per_second
+        delay = start - now
+
+    if client is None:
+      client = self.make_client()
+    if delay > 0:
+      time.sleep(delay)
+    return client
+
+  def release(self, host, client):
+    with self.condition:
+      self.in_flight -= 1
+      self.active[host] -= 1
+      self.idle.setdefault(host, []).append(client)
+      self.condition.notify_all()
+
+  def set_timeout(self, client, timeout):
+    # Pooled clients may already have open connections which need the new
+    # timeout as well
+    client.timeout = timeout
+    for conn in client.connections.values():
+      conn.timeout = timeout
+      if getattr(conn, 'sock', None) is not None:
+        conn.sock.settimeout(timeout)
+
+  def stream(self, uri, headers, consume, timeout=None):
+    # Open uri and call consume with the response and a file to read the body
+    # from, holding a connection slot for host until consume returns
+    host = urlparse.urlsplit(uri)[1].lower()
+    client = self.acquire(host)
+    try:
+      self.count('connections_opened')
+      try:
+        if timeout is None:
+          f = urllib2.urlopen(urllib2.Request(uri, headers=headers))
+        else:
+          f = urllib2.urlopen(urllib2.Request(uri, headers=headers), timeout=timeout)
+        info = dict(f.info().items())
+        info['status'] = f.getcode()
+      except urllib2.HTTPError, e:
+        f = e
+        info = dict(e.info().items())
+        info['status'] = e.code
+      try:
+        return consume(httplib2.Response(info), f)
+      finally:
+        f.close()
+    finally:
+      self.release(host, client)
+
+  def make_client(self):
+    client = httplib2.Http()
+    client.follow_all_redirects = True
+    return client
+
+  def count(self, name):
+    with self.condition:
+      self.counters[name] += 1
+
+  def stats(self):
+    with self.condition:
+      stats = dict(self.counters)
+    if stats['requests'] > 0:
+      stats['client_reuse_rate'] = float(stats['clients_reused']) / stats['requests']
+      stats['connection_reuse_rate'] = float(stats['connections_reused']) / stats['requests']
+    else:
+      stats['client_reuse_rate'] = 0.0
+      stats['connection_reuse_rate'] = 0.0
+    return stats
+
+
+class RDFLibStore(IOMemory):
+  # The triples of an AggregatingGraph kept in rdflib's memory store, which
+  # indexes them by subject, predicate and object, with the queries below.
+  # Lists of terms have one entry per triple. Literals are never expanded so
+  # their inbound arcs are not looked up.
+  def predicates(self, s):
+    return [p for ((_, p, o), contexts) in self.triples((s, None, None))]
+
+  def objects(self, s, p):
+    return [o for ((_, _, o), contexts) in self.triples((s, p, None))]
+
+  def subjects(self, p, o):
+    if isinstance(o, Literal):
+      return []
+    return [s for ((s, _, _), contexts) in self.triples((None, p, o))]
+
+  def inbound_predicates(self, o):
+    if isinstance(o, Literal):
+      return []
+    return [p for ((s, p, _), contexts) in self.triples((None, None, o))]
+
+  def __contains__(self, triple):
+    for t in self.triples(triple):
+      return True
+    return False
+
+
+class CompactStore(Store):
+  # An rdflib store that keeps triples as integer ids rather than Python
+  # objects. Contexts are not kept, so every graph over the store sees all of
+  # its triples. A
+  # term dictionary gives each distinct term an id, and the indexes hold
+  # arrays of ids: the (predicate, object) pairs of each subject and, for
+  # each object, the subjects of each of its predicates. Literal objects are
+  # not in the second index since inbound arcs are only followed to resources.
+  SCAN_LIMIT = 16
+
+  def __init__(self, configuration=None, identifier=None):
+    Store.__init__(self, configuration, identifier)
+    self.ids = {}
+    self.terms = []
+    self.spo = {}
+    self.ops = {}
+    # the pairs of subjects with more than SCAN_LIMIT of them, to find
+    # duplicate triples without scanning
+    self.pair_sets = {}
+    self.size = 0
+
+  def term_id(self, term):
+    i = self.ids.get(term)
+    if i is None:
+      i = self.ids[term] = len(self.terms)
+      self.terms.append(term)
+    return i
+
+  def add(self, triple, context, quoted=False):
+    Store.add(self, triple, context, quoted)
+    (s, p, o) = triple
+    si = self.term_id(s)
+    pi = self.term_id(p)
+    oi = self.term_id(o)
+    pairs = self.spo.get(si)
+    if pairs is None:
+      pairs = self.spo[si] = array('i')
+    elif self.has_pair(si, pairs, pi, oi):
+      return
+    pairs.append(pi)
+    pairs.append(oi)
+    pair_set = self.pair_sets.get(si)
+    if pair_set is not None:
+      pair_set.add((pi, oi))
+    elif len(pairs) > 2 * self.SCAN_LIMIT:
+      self.pair_sets[si] = set((pairs[i], pairs[i + 1]) for i in xrange(0, len(pairs), 2))
+    if not isinstance(o, Literal):
+      self.ops.setdefault(oi, {}).setdefault(pi, array('i')).append(si)
+    self.size += 1
+
+  def addN(self, quads):
+    for (s, p, o, c) in quads:
+      self.add((s, p, o), c)
+
+  def remove(self, triple, context=None):
+    # Removes every triple matching the pattern. Terms stay in the dictionary.
+    Store.remove(self, triple, context)
+    ids = self.ids
+    for ((s, p, o), contexts) in list(self.triples(triple)):
+      si = ids[s]
+      pi = ids[p]
+      oi = ids[o]
+      pairs = self.spo[si]
+      for i in xrange(0, len(pairs), 2):
+        if pairs[i] == pi and pairs[i + 1] == oi:
+          del pairs[i:i + 2]
+          break
+      if len(pairs) == 0:
+        del self.spo[si]
+      pair_set = self.pair_sets.get(si)
+      if pair_set is not None:
+        pair_set.discard((pi, oi))
+      if not isinstance(o, Literal):
+        by_predicate = self.ops[oi]
+        by_predicate[pi].remove(si)
+        if len(by_predicate[pi]) == 0:
+          del by_predicate[pi]
+          if len(by_predicate) == 0:
+            del self.ops[oi]
+      self.size -= 1
+
+  def triples(self, triple, context=None):
+    # The triples matching a pattern, each with no contexts
+    (s, p, o) = triple
+    ids = self.ids
+    terms = self.terms
+    (si, pi, oi) = (ids.get(s), ids.get(p), ids.get(o))
+    if (s is not None and si is None) or (p is not None and pi is None) or (o is not None and oi is None):
+      return
+    if s is not None:
+      if p is not None and o is not None:
+        if self.has_pair(si, self.spo.get(si, ()), pi, oi):
+          yield (triple, iter(()))
+        return
+      subjects = [si]
+    elif o is not None and not isinstance(o, Literal):
+      by_predicate = self.ops.get(oi, {})
+      for pj in ([pi] if p is not None else list(by_predicate)):
+        for sj in list(by_predicate.get(pj, ())):
+          yield ((terms[sj], terms[pj], o), iter(()))
+      return
+    else:
+      subjects = list(self.spo)
+    for sj in subjects:
+      pairs = self.spo.get(sj, ())
+      for i in xrange(0, len(pairs), 2):
+        if (p is None or pairs[i] == pi) and (o is None or pairs[i + 1] == oi):
+          yield ((terms[sj], terms[pairs[i]], terms[pairs[i + 1]]), iter(()))
+
+  def has_pair(self, si, pairs, pi, oi):
+    pair_set = self.pair_sets.get(si)
+    if pair_set is not None:
+      return (pi, oi) in pair_set
+    for i in xrange(0, len(pairs), 2):
+      if pairs[i] == pi and pairs[i + 1] == oi:
+        return True
+    return False
+
+  def predicates(self, s):
+    pairs = self.spo.get(self.ids.get(s), ())
+    terms = self.terms
+    return [terms[pairs[i]] for i in xrange(0, len(pairs), 2)]
+
+  def objects(self, s, p):
+    pi = self.ids.get(p)
+    pairs = self.spo.get(self.ids.get(s), ())
+    terms = self.terms
+    return [terms[pairs[i + 1]] for i in xrange(0, len(pairs), 2) if pairs[i] == pi]
+
+  def subjects(self, p, o):
+    terms = self.terms
+    return [terms[i] for i in self.ops.get(self.ids.get(o), {}).get(self.ids.get(p), ())]
+
+  def inbound_predicates(self, o):
+    terms = self.terms
+    return [terms[pi] for (pi, subjects) in self.ops.get(self.ids.get(o), {}).iteritems() for i in subjects]
+
+  def __contains__(self, triple):
+    (s, p, o) = triple
+    si = self.ids.get(s)
+    pi = self.ids.get(p)
+    oi = self.ids.get(o)
+    if si is None or pi is None or oi is None:
+      return False
+    return self.has_pair(si, self.spo.get(si, ()), pi, oi)
+
+  def __len__(self, context=None):
+    return self.size
+
+
 class AggregatingGraph:
-  def __init__(self):
-    self.g = rdflib.Graph()
+  def __init__(self, max_workers=8, cache=None, scheduler=None, stream=False, chunk_size=65536, negative_cache=None, archive=None, store=None):
+    # the triples are kept in store, an RDFLibStore unless another store such
+    # as a CompactStore is given, and g is an rdflib graph over them
+    if store is not None:
+      self.store = store
+    else:
+      self.store = RDFLibStore()
+    self.g = rdflib.Graph(store=self.store)
+    # rdf:type index: each type's set of members and each subject's set of types
+    self.types = {}
+    self.subject_types = {}
+    self.literal_values = {}
     self.prefixes = {}
     self.lookups = {}
-    self.client = httplib2.Http()
-    self.client.follow_all_redirects = True
+    self.documents = {}
+    self.max_workers = max_workers
+    self.cache = cache
+    self.stream = stream
+    self.chunk_size = chunk_size
+    self.negative_cache = negative_cache
+    self.archive = archive
+    self.local = threading.local()
+    if scheduler:
+      self.scheduler = scheduler
+    else:
+      self.scheduler = FetchScheduler()
+    self.lock = threading.RLock()
+    self.store.dispatcher.subscribe(TripleAddedEvent, self.triple_added)
+    self.store.dispatcher.subscribe(TripleRemovedEvent, self.triple_removed)
 
     self.bind('rdf', 'http://www.w3.org/1999/02/22-rdf-syntax-ns#')
     self.bind('rdfs', 'http://www.w3.org/2000/01/rdf-schema#')
@@ -36,23 +1040,316 @@ class AggregatingGraph:
     
     
   def lookup(self, uri):
-    s = str(uri)
-    if not s.startswith("http:"):
-      return
-    if s not in self.lookups:
-      self.lookups[s] = 1
-      lookup_uri = re.sub("\#.+$", '', uri)
-      response, body = self.client.request(lookup_uri, "GET",headers={"accept" : "text/turtle, application/rdf+xml;q=0.9, application/xml;q=0.1, text/xml;q=0.1"})
-      if response.status in range(200, 300):
-        self.lookups[s] = 1
+    self.lookup_many([uri])
+
+  def lookup_many(self, uris):
+    # Each document is fetched once however many fragment uris refer to it.
+    # self.documents maps a document uri to a Future that is finished once the
+    # document has been fetched and parsed, and self.lookups maps each uri that
+    # has been looked up to the Future for its document. Uris whose document is
+    # already being fetched by another thread wait for that fetch to finish.
+    limits = self.get_limits()
+    pending = []
+    waiting = []
+    seen = set()
+    with self.lock:
+      for uri in uris:
+        s = str(uri)
+        if not s.startswith("http:"):
+          continue
+        doc = self.lookups.get(s)
+        if doc is None:
+          doc_uri = re.sub("\#.+$", '', s)
+          doc = self.documents.get(doc_uri)
+          if doc is None:
+            if self.negative_cache is not None and self.negative_cache.is_failing(doc_uri):
+              doc = Future()
+              doc.uri = doc_uri
+              doc.set_result(doc_uri)
+              self.documents[doc_uri] = doc
+            else:
+              if limits is not None and not limits.allow():
+                continue
+              doc = Future()
+              doc.uri = doc_uri
+              self.documents[doc_uri] = doc
+              pending.append(doc)
+              seen.add(doc)
+          self.lookups[s] = doc
+        if not doc.done() and doc not in seen:
+          waiting.append(doc)
+          seen.add(doc)
+
+    if len(pending) > 0:
+      timeout = None
+      if limits is not None:
+        timeout = limits.request_timeout()
+      abandoned = []
+      try:
+        error = None
+        for (doc, result) in zip(pending, self.fetch_many([doc.uri for doc in pending], timeout)):
+          if isinstance(result, Exception):
+            if isinstance(result, FETCH_ERRORS):
+              # running out of the time the query's limits allow says nothing
+              # about the host, so only other failures are remembered
+              if self.negative_cache is not None and not (timeout is not None and is_timeout(result)):
+                self.negative_cache.failed(doc.uri, 'network')
+              if limits is not None:
+                # a query with limits gives up on documents that time out,
+                # leaving them to be fetched again by later queries
+                limits.complete = False
+                abandoned.append(doc)
+              elif error is None:
+                error = result
+            elif error is None:
+              error = result
+          else:
+            (response, body) = result
+            if limits is not None:
+              if body is not None:
+                limits.record(len(body))
+              else:
+                limits.record(int(response.get('content-length', 0)))
+            failure = self.ingest(response, body, doc.uri)
+            if self.negative_cache is not None:
+              if failure is None:
+                self.negative_cache.succeeded(doc.uri)
+              else:
+                self.negative_cache.failed(doc.uri, failure, response.status)
+          doc.set_result(doc.uri)
+      finally:
+        for doc in pending:
+          if not doc.done():
+            doc.set_result(doc.uri)
+        if len(abandoned) > 0:
+          with self.lock:
+            for doc in abandoned:
+              if self.documents.get(doc.uri) is doc:
+                del self.documents[doc.uri]
+            for (uri, doc) in self.lookups.items():
+              if doc in abandoned:
+                del self.lookups[uri]
+
+      if error is not None:
+        raise error
+
+    for doc in waiting:
+      if limits is None:
+        doc.wait()
+      elif not doc.wait(limits.request_timeout()):
+        # another query's fetch of the document hasn't finished in the time
+        # this query's limits allow
+        limits.complete = False
+
+  def get_limits(self):
+    return getattr(self.local, 'limits', None)
+
+  def get_memo(self):
+    return getattr(self.local, 'memo', None)
+
+  def set_memo(self, memo):
+    # Remember the filter results of the current thread's query in memo,
+    # returning the memo it replaces
+    previous = self.get_memo()
+    self.local.memo = memo
+    return previous
+
+  def set_limits(self, limits):
+    # Apply limits to the lookups made by the current thread, returning the
+    # limits they replace
+    previous = self.get_limits()
+    self.local.limits = limits
+    return previous
+
+  def fetch_many(self, uris, timeout=None):
+    # Fetch each uri using a bounded number of threads. Results are returned in
+    # the same order as uris, with any exception raised by a fetch in place of
+    # its (response, body) pair
+    results = [None] * len(uris)
+    queue = Queue.Queue()
+    for i in range(len(uris)):
+      queue.put(i)
+
+    def worker():
+      while True:
         try:
-          if 'text/turtle' in response['content-type']:
-            self.g.parse(StringInputSource(body), format="n3")
-          elif 'application/rdf+xml' in response['content-type'] or 'application/xml' in response['content-type']:
-            self.g.parse(StringInputSource(body), format="xml")
-        except BadSyntax:
-          pass
-        
+          i = queue.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          results[i] = self.retrieve(uris[i], timeout)
+        except Exception, e:
+          results[i] = e
+
+    workers = min(self.max_workers, len(uris))
+    if workers < 2:
+      worker()
+    else:
+      threads = []
+      for i in range(workers):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+      for t in threads:
+        t.join()
+
+    return results
+
+  def retrieve(self, uri, timeout=None):
+    # Get the document at uri, from the cache if there is a fresh copy. A stale
+    # copy is revalidated with a conditional request. When recording, the
+    # archive keeps the response that is ingested, whether it was fetched or
+    # came from the cache, so the crawl replays the same way.
+    if self.stream and self.cache is None and self.archive is None:
+      return self.fetch_stream(uri, {"accept" : STREAM_ACCEPT}, lambda response, f: self.consume(response, f, uri), timeout)
+
+    headers = {"accept" : ACCEPT}
+    entry = None
+    cached = None
+    if self.cache is not None:
+      entry = self.cache.get(uri)
+      if entry is not None:
+        if self.cache.is_fresh(entry):
+          cached = self.cache.load(uri, entry)
+        if cached is None:
+          if entry.get('etag'):
+            headers['if-none-match'] = entry['etag']
+          if entry.get('last-modified'):
+            headers['if-modified-since'] = entry['last-modified']
+
+    if cached is not None:
+      (response, body) = cached
+    else:
+      if self.archive is not None and self.archive.is_replaying():
+        (response, body) = self.archive.replay(uri)
+      else:
+        (response, body) = self.fetch(uri, headers, timeout)
+
+      if self.cache is not None:
+        if response.status == 304 and entry is not None:
+          cached = self.cache.load(uri, entry)
+          if cached is not None:
+            self.cache.refresh(uri, entry)
+            (response, body) = cached
+        elif response.status in range(200, 300):
+          self.cache.put(uri, response, body)
+
+    if self.archive is not None and not self.archive.is_replaying():
+      self.archive.record(uri, headers, response, body)
+    return (response, body)
+
+  def fetch(self, uri, headers, timeout=None):
+    return self.scheduler.request(uri, headers, timeout)
+
+  def fetch_stream(self, uri, headers, consume, timeout=None):
+    return self.scheduler.stream(uri, headers, consume, timeout)
+
+  def consume(self, response, f, uri):
+    # Parse N-Triples, N-Quads and RDF/XML as they are read so only a chunk of
+    # the document is held in memory at a time. The body of other documents is
+    # read in full and returned to be parsed by ingest. Streamed documents are
+    # returned with a body of None.
+    if response.status in range(200, 300):
+      content_type = response.get('content-type', '').split(';')[0].strip().lower()
+      sink = TripleSink(self)
+      f = CountingReader(f)
+      if content_type in STREAM_LINE_TYPES:
+        try:
+          LineParser(sink).parse(f)
+        except NTriplesParseError:
+          response.failure = 'syntax'
+        sink.flush()
+        response['content-length'] = str(f.count)
+        return (response, None)
+
+      elif content_type in STREAM_XML_TYPES:
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+        parser.setContentHandler(StreamRDFXMLHandler(sink, uri, parser))
+        parser.setErrorHandler(RDFXMLErrorHandler())
+        try:
+          while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+              break
+            parser.feed(chunk)
+            sink.flush()
+          parser.close()
+        except xml.sax.SAXParseException:
+          response.failure = 'syntax'
+        sink.flush()
+        response['content-length'] = str(f.count)
+        return (response, None)
+
+    return (response, f.read())
+
+  def add_triples(self, triples):
+    with self.lock:
+      self.store.addN((s, p, o, self.g) for (s, p, o) in triples)
+
+  def triple_added(self, event):
+    # The store's events keep the type index up to date however triples reach
+    # it, through add_triples or through g
+    (s, p, o) = event.triple
+    if p == RDF['type']:
+      with self.lock:
+        self.types.setdefault(o, set()).add(s)
+        self.subject_types.setdefault(s, set()).add(o)
+
+  def triple_removed(self, event):
+    # The event names a pattern and comes before the matching triples are
+    # removed, so they can still be found
+    (s, p, o) = event.triple
+    if p is None or p == RDF['type']:
+      with self.lock:
+        for ((member, _, t), contexts) in list(self.store.triples((s, RDF['type'], o))):
+          self.types.get(t, set()).discard(member)
+          self.subject_types.get(member, set()).discard(t)
+
+  def ingest(self, response, body, uri=None):
+    # Parse the document into the graph. Returns None if it was parsed, or
+    # the reason it was not: 'status', 'content-type' or 'syntax'.
+    if response.status not in range(200, 300):
+      return 'status'
+
+    if body is None:
+      # already parsed while streaming
+      return getattr(response, 'failure', None)
+
+    if 'text/turtle' in response['content-type']:
+      format = "n3"
+    elif 'application/rdf+xml' in response['content-type'] or 'application/xml' in response['content-type']:
+      format = "xml"
+    else:
+      return 'content-type'
+
+    # Documents are parsed on their own and then added to the graph. When
+    # caching, a snapshot of their triples is cached with them and loaded in
+    # place of parsing next time
+    caching = self.cache is not None and uri is not None
+    if caching and getattr(response, 'fromcache', False):
+      data = self.cache.load_snapshot(uri)
+      if data is not None:
+        try:
+          triples = load_triples(data)
+        except SNAPSHOT_ERRORS:
+          # the document is parsed again instead, which replaces the snapshot
+          self.cache.remove_snapshot(uri)
+        else:
+          self.add_triples(triples)
+          return None
+
+    failure = None
+    doc = rdflib.Graph()
+    try:
+      doc.parse(StringInputSource(body), format=format)
+      if caching:
+        self.cache.put_snapshot(uri, dump_triples(doc))
+    except (BadSyntax, xml.sax.SAXParseException):
+      failure = 'syntax'
+    self.add_triples(doc)
+    return failure
 
   def bind(self, prefix, ns):
     self.prefixes[prefix] = ns
@@ -66,7 +1363,8 @@ class AggregatingGraph:
 
   def get_subject_properties(self, s, distinct):
     self.lookup(s)
-    props = list(self.g.predicates(s, None))
+    with self.lock:
+      props = self.store.predicates(s)
     if distinct:
       return list(set(props))
     else:
@@ -74,14 +1372,208 @@ class AggregatingGraph:
     
   def get_subject_property_values(self, s, p):
     self.lookup(s)
-    return [o for (s1,p1,o) in self.g.triples((s,p,None))]
+    with self.lock:
+      return self.store.objects(s, p)
+
+  def get_object_properties(self, o, distinct):
+    return self.get_objects_properties([o], distinct)[0]
+
+  def get_object_property_subjects(self, o, p):
+    return self.get_objects_property_subjects([(o, p)])[0]
+
+  def literal_value(self, term):
+    # The string a term stands for and its number, or None if it is not
+    # numeric. Each distinct lexical form is only converted once.
+    lexical = unicode(term)
+    value = self.literal_values.get(lexical)
+    if value is None:
+      number = None
+      if isnumeric(lexical):
+        number = float(lexical)
+      value = (lexical, number)
+      self.literal_values[lexical] = value
+    return value
+
+  def get_types(self, s):
+    self.lookup(s)
+    with self.lock:
+      return set(self.subject_types.get(s, ()))
 
   def has_triple(self, s,p,o):
     self.lookup(s)
-    if (s,p,o) in self.g:
-      return True
-    else:
-      return False
+    with self.lock:
+      if (s,p,o) in self.store:
+        return True
+      else:
+        return False
+
+  def get_subjects_properties(self, subjects, distinct, predicates=None):
+    # The properties of each subject, looking up all the subjects at once.
+    # Subjects that appear more than once are only queried once. If a set of
+    # predicates is given only those properties are returned.
+    unique = set(subjects)
+    self.lookup_many(unique)
+    with self.lock:
+      if predicates is None:
+        props = dict((s, self.store.predicates(s)) for s in unique)
+      else:
+        props = dict((s, [p for p in predicates for o in self.store.objects(s, p)]) for s in unique)
+    if distinct:
+      props = dict((s, list(set(p))) for (s, p) in props.iteritems())
+    return [props[s] for s in subjects]
+
+  def get_subjects_property_values(self, pairs):
+    # The values of each (subject, property) pair
+    unique = set(pairs)
+    self.lookup_many(set(s for (s, p) in unique))
+    with self.lock:
+      values = dict(((s, p), self.store.objects(s, p)) for (s, p) in unique)
+    return [values[pair] for pair in pairs]
+
+  def get_objects_properties(self, objects, distinct, predicates=None):
+    # The properties of the triples each object is the value of, once for
+    # each subject unless distinct. Only the triples in documents that have
+    # been fetched are known, so each object is looked up first.
+    unique = set(objects)
+    self.lookup_many(unique)
+    with self.lock:
+      props = {}
+      for o in unique:
+        if predicates is None:
+          props[o] = self.store.inbound_predicates(o)
+        else:
+          props[o] = [p for p in predicates for s in self.store.subjects(p, o)]
+    if distinct:
+      props = dict((o, list(set(p))) for (o, p) in props.iteritems())
+    return [props[o] for o in objects]
+
+  def get_objects_property_subjects(self, pairs):
+    # The subjects of each (object, property) pair
+    unique = set(pairs)
+    self.lookup_many(set(o for (o, p) in unique))
+    with self.lock:
+      subjects = dict(((o, p), self.store.subjects(p, o)) for (o, p) in unique)
+    return [subjects[pair] for pair in pairs]
+
+  def get_typed_subjects(self, subjects, t):
+    # The set of subjects that have type t
+    unique = set(subjects)
+    self.lookup_many(unique)
+    with self.lock:
+      return unique & self.types.get(t, set())
+
+class LRUCache:
+  def __init__(self, size):
+    self.size = size
+    self.items = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      if key not in self.items:
+        self.misses += 1
+        return None
+      value = self.items.pop(key)
+      self.items[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.items.pop(key, None)
+      self.items[key] = value
+      while len(self.items) > self.size:
+        self.items.popitem(last=False)
+
+  def __len__(self):
+    return len(self.items)
+
+
+class Future:
+  def __init__(self):
+    self.event = threading.Event()
+    self.lock = threading.Lock()
+    self.callbacks = []
+    self.value = None
+    self.error = None
+
+  def done(self):
+    return self.event.is_set()
+
+  def wait(self, timeout=None):
+    return self.event.wait(timeout)
+
+  def result(self, timeout=None):
+    if not self.event.wait(timeout):
+      raise EvaluationError("Timed out after %s seconds waiting for result" % timeout)
+    if self.error is not None:
+      raise self.error
+    return self.value
+
+  def add_done_callback(self, fn):
+    # fn is called with this future once it has a result, immediately if it
+    # already has one
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(fn)
+        return
+    fn(self)
+
+  def set_result(self, value):
+    self.value = value
+    self.finish()
+
+  def set_exception(self, error):
+    self.error = error
+    self.finish()
+
+  def finish(self):
+    with self.lock:
+      self.event.set()
+      callbacks = self.callbacks
+      self.callbacks = []
+    for fn in callbacks:
+      fn(self)
+
+
+class WorkerPool:
+  def __init__(self, size):
+    self.size = size
+    self.queue = Queue.Queue()
+    self.threads = []
+    self.lock = threading.Lock()
+
+  def submit(self, fn, *args):
+    future = Future()
+    with self.lock:
+      if len(self.threads) < self.size:
+        t = threading.Thread(target=self.work)
+        t.setDaemon(True)
+        t.start()
+        self.threads.append(t)
+    self.queue.put((future, fn, args))
+    return future
+
+  def close(self):
+    # Stop the threads once the work already submitted is done
+    with self.lock:
+      for t in self.threads:
+        self.queue.put(None)
+      self.threads = []
+
+  def work(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      (future, fn, args) = item
+      try:
+        future.set_result(fn(*args))
+      except Exception, e:
+        future.set_exception(e)
+
 
 class Location:
   def __init__(self, value, g):
@@ -89,7 +1581,7 @@ class Location:
     self.g = g
     
   def is_type(self, uri):
-    return self.g.has_triple(self.value, RDF['type'], uri)
+    return uri in self.g.get_types(self.value)
 
 
   def compare(self, other, op='='):
@@ -101,13 +1593,11 @@ class Location:
       if not isinstance(self.value, Literal) or not isinstance(other.value, Literal):
         return False
     
-    
-    if not isnumeric(self.value) or not isnumeric(other.value):
+    left = self.g.literal_value(self.value)[1]
+    right = self.g.literal_value(other.value)[1]
+    if left is None or right is None:
         return False
     
-    left = float(self.value)
-    right = float(other.value)
-    
     if op == '>':
       return left > right;
     elif op == '<':
@@ -139,9 +1629,14 @@ class Node(Location):
   def is_uri(self):
     return isinstance(self.value, URIRef)
 
-  def get_arcs(self, distinct=False):
+  def get_arcs(self, distinct=False, predicates=None, inbound=False):
+    if inbound:
+      return expand([self], self.g, distinct, False, predicates, True)[0]
     arcs = []
-    properties = self.g.get_subject_properties(self.value, distinct)
+    if predicates is None:
+      properties = self.g.get_subject_properties(self.value, distinct)
+    else:
+      properties = self.g.get_subjects_properties([self.value], distinct, predicates)[0]
     for p in properties:
       arcs.append(Arc(p, self.value,self.g))
 
@@ -151,11 +1646,16 @@ class Node(Location):
 
 
 class Arc(Location):
-  def __init__(self, value, node, g):
+  # An inverse arc is one of the arcs pointing to node, followed backwards
+  # from its object to its subjects
+  def __init__(self, value, node, g, inverse=False):
     self.node = node
+    self.inverse = inverse
     Location.__init__(self,value, g)
 
   def __str__(self):
+    if self.inverse:
+      return "%s <- %s" % (self.node, self.value)
     return "%s -> %s" % (self.node, self.value)
 
   def is_arc(self):
@@ -169,37 +1669,208 @@ class Arc(Location):
 
   def get_nodes(self):
     nodes = []
-    for n in self.g.get_subject_property_values(self.node, self.value):
+    if self.inverse:
+      values = self.g.get_object_property_subjects(self.node, self.value)
+    else:
+      values = self.g.get_subject_property_values(self.node, self.value)
+    for n in values:
       nodes.append(Node(n,self.g))
 
     return nodes
 
 
 class LinkPathProcessor:
-  def __init__(self, g = None):
+  def __init__(self, g = None, max_queries = 16, max_plans = 256):
     if g:
       self.g = g
     else:
       self.g = AggregatingGraph()
+    self.queries = WorkerPool(max_queries)
+    self.plans = LRUCache(max_plans)
 
 
   def bind(self, prefix, ns):
     self.g.bind(prefix, ns)
 
-  def select(self, uri, path, trace=False):
+  def select(self, uri, path, trace=False, max_documents=None, max_bytes=None, timeout=None, deadline=None):
+    # max_documents and max_bytes limit how much the query fetches, timeout
+    # limits each request and deadline the whole query, in seconds. When a
+    # limit is reached the query stops fetching and the results selected from
+    # the data it has are returned with complete set to False.
     uris = []
 
-    parsed_path = self.parse_path(path)
-    candidates = Node(URIRef(uri),self.g).get_arcs()
-    ret = parsed_path.select(candidates, self.g, None, trace)
+    limits = make_limits(max_documents, max_bytes, timeout, deadline)
+
+    memo = FilterMemo()
+    previous = self.g.set_limits(limits)
+    previous_memo = self.g.set_memo(memo)
+    try:
+      plan = self.compile(path, trace)
+      ret = plan(self.get_start_arcs(uri, plan), None)
+    finally:
+      self.g.set_limits(previous)
+      self.g.set_memo(previous_memo)
     
-    results = []
-    for r in ret:
-      if r.value not in results:
+    return self.make_results(ret, limits is None or limits.complete, memo)
+
+  def select_multi(self, uri, paths, max_documents=None, max_bytes=None, timeout=None, deadline=None):
+    # Evaluate several paths from uri, given as a dict of names to paths.
+    # Returns a dict of names to results. The steps that paths start with are
+    # evaluated once for all of them.
+    limits = make_limits(max_documents, max_bytes, timeout, deadline)
+
+    selected = {}
+    memo = FilterMemo()
+    previous = self.g.set_limits(limits)
+    previous_memo = self.g.set_memo(memo)
+    try:
+      plan = self.compile_multi(paths)
+      plan([Node(URIRef(uri), self.g)], selected)
+    finally:
+      self.g.set_limits(previous)
+      self.g.set_memo(previous_memo)
+
+    complete = limits is None or limits.complete
+    return dict((name, self.make_results(selected.get(name, []), complete, memo)) for name in paths)
+
+  def compile_multi(self, paths):
+    # Returns a function of (starts, selected) that evaluates every path in
+    # paths from the starting nodes, setting selected[name] to the resources
+    # each one selects
+    key = (tuple(sorted(paths.items())), tuple(sorted(self.g.prefixes.items())), 'multi')
+    plan = self.plans.get(key)
+    if plan is None:
+      trie = PathTrie()
+      for (name, path) in paths.iteritems():
+        trie.add(self.parse_path(path).steps, name)
+      plan = trie.compile(self.g)
+      self.plans.put(key, plan)
+    return plan
+
+  def make_results(self, selected, complete, memo=None):
+    # The distinct values of the selected resources, in the order selected
+    if memo is not None and memo.truncated:
+      complete = False
+    results = Results(complete = complete)
+    if memo is not None:
+      results.memo_hits = memo.hits
+      results.memo_misses = memo.misses
+    seen = set()
+    for r in selected:
+      if r.value not in seen:
+        seen.add(r.value)
         results.append(r.value)
 
     return results
 
+  def select_many(self, uris, path, workers=1, batch_size=100):
+    # Evaluate path from each of uris, generating (uri, results) pairs in the
+    # order of uris. The path is compiled once and the starting resources are
+    # evaluated batch_size at a time as one frontier, so documents they have
+    # in common are fetched once and resources they share are tested once.
+    # Up to workers batches are evaluated at the same time.
+    plan = self.compile(path)
+    pool = WorkerPool(workers)
+    pending = []
+    try:
+      batch = []
+      for uri in uris:
+        batch.append(uri)
+        if len(batch) == batch_size:
+          pending.append((batch, pool.submit(self.select_batch, plan, batch)))
+          batch = []
+          if len(pending) >= workers:
+            (done, future) = pending.pop(0)
+            for pair in izip(done, future.result()):
+              yield pair
+      if len(batch) > 0:
+        pending.append((batch, pool.submit(self.select_batch, plan, batch)))
+      while len(pending) > 0:
+        (done, future) = pending.pop(0)
+        for pair in izip(done, future.result()):
+          yield pair
+    finally:
+      pool.close()
+
+  def select_batch(self, plan, uris):
+    memo = FilterMemo()
+    previous_memo = self.g.set_memo(memo)
+    try:
+      starts = [Node(URIRef(uri), self.g) for uri in uris]
+      selected = plan.select_groups(expand(starts, self.g, True, False, plan.predicates, plan.inbound))
+    finally:
+      self.g.set_memo(previous_memo)
+    # the memo is shared by the whole batch so its counts are not given to
+    # the results of each uri, and a repeated step cut short from any uri
+    # marks the results of the whole batch incomplete
+    return [self.make_results(s, not memo.truncated) for s in selected]
+
+  def iselect(self, uri, path, limit=None, max_documents=None, max_bytes=None, timeout=None, deadline=None):
+    # Generate the distinct results of path in the order they are found,
+    # stopping once limit results have been produced. Documents are only
+    # fetched as evaluation reaches them.
+    if limit is not None and limit <= 0:
+      return
+
+    limits = make_limits(max_documents, max_bytes, timeout, deadline)
+
+    plan = self.compile(path)
+    seen = set()
+    memo = FilterMemo()
+    # the limits and memo only apply while the generator is running, not
+    # while the caller holds a result
+    previous = self.g.set_limits(limits)
+    previous_memo = self.g.set_memo(memo)
+    try:
+      for r in plan.iterate(self.get_start_arcs(uri, plan)):
+        if r.value in seen:
+          continue
+        seen.add(r.value)
+        self.g.set_limits(previous)
+        self.g.set_memo(previous_memo)
+        try:
+          yield r.value
+        finally:
+          previous = self.g.set_limits(limits)
+          previous_memo = self.g.set_memo(memo)
+        if limit is not None and len(seen) >= limit:
+          return
+    finally:
+      self.g.set_limits(previous)
+      self.g.set_memo(previous_memo)
+
+  def aselect(self, uri, path, callback=None, trace=False, max_documents=None, max_bytes=None, timeout=None, deadline=None):
+    # Evaluate path without blocking the caller. Returns a Future holding the
+    # results of select; callback, if given, is called with that future when
+    # the evaluation finishes. Queries share a fixed pool of max_queries
+    # evaluation threads and the lookups for each step run concurrently.
+    future = self.queries.submit(self.select, uri, path, trace, max_documents, max_bytes, timeout, deadline)
+    if callback is not None:
+      future.add_done_callback(callback)
+    return future
+
+  def compile(self, path, trace=False):
+    # Returns a function of (candidates, context) that evaluates path. Compiled
+    # paths are cached by path and the prefixes they were compiled with.
+    key = (path, tuple(sorted(self.g.prefixes.items())), trace)
+    plan = self.plans.get(key)
+    if plan is None:
+      parsed_path = self.parse_path(path)
+      if trace:
+        g = self.g
+        plan = lambda candidates, context: parsed_path.select(candidates, g, context, True)
+        plan.predicates = None
+        plan.inbound = len(parsed_path.steps) > 0 and is_inbound(parsed_path.steps[0])
+      else:
+        plan = parsed_path.compile(self.g)
+      self.plans.put(key, plan)
+    return plan
+
+  def get_start_arcs(self, uri, plan):
+    # The arcs of uri that the first step of plan is matched against, one for
+    # each property, since each arc leads to all of the property's values
+    return Node(URIRef(uri), self.g).get_arcs(True, plan.predicates, plan.inbound)
+
   def parse_path(self, v):
     (step, v) = self.m_locationpath(v)
     return step;
@@ -264,6 +1935,8 @@ class LinkPathProcessor:
       else:
         return (False, v);
 
+    (repeat, v) = self.m_repeat(v)
+
     filters = []
     (r, v) = self.m_openbracket(v)
     while r:
@@ -274,11 +1947,30 @@ class LinkPathProcessor:
         (r_br, v) = self.m_closebracket(v)
         (r, v) = self.m_openbracket(v)
 
-    return (StepMatcher(selector, axis, filters), v);
+    return (StepMatcher(selector, axis, filters, repeat), v);
 
   def m_axis(self, v):
     return self.m_split(r'(in|out)::', v)
 
+  def m_repeat(self, v):
+    # + or {m,n} after a step, returning the (least, most) number of times the
+    # step repeats with most None for no maximum, or None if it doesn't repeat
+    r = self.m(r'(\+)', v)
+    if r:
+      return ((1, None), r[2])
+    matches = re.search(r'^\s*\{\s*(\d+)\s*(,\s*(\d*)\s*)?\}(.*)$', v, re.S)
+    if not matches:
+      return (None, v)
+    least = int(matches.group(1))
+    most = least
+    if matches.group(2):
+      most = None
+      if matches.group(3):
+        most = int(matches.group(3))
+    if least < 1 or (most is not None and most < least):
+      raise ParseError("Expecting a step to repeat at least once and at most no fewer times at %s" % v)
+    return ((least, most), matches.group(4))
+
   def m_slash(self,v):
     return self.m_split(r'(\/)', v)
 
@@ -511,9 +2203,81 @@ class LinkPathProcessor:
     return self.m_split(r'(\])', v);
 
 
+class PathTrie:
+  # Several paths merged by the steps they start with, so that a step shared
+  # by more than one path is matched once and the frontier is only split
+  # where the paths diverge. Steps are the same if they are written the same.
+  def __init__(self, step=None):
+    self.step = step
+    self.children = OrderedDict()
+    self.names = []
+
+  def add(self, steps, name):
+    node = self
+    for step in steps:
+      key = str(step)
+      child = node.children.get(key)
+      if child is None:
+        child = node.children[key] = PathTrie(step)
+      node = child
+    node.names.append(name)
+
+  def predicates(self, g, children):
+    # The properties of the arcs any of children's steps can match
+    predicates = set()
+    for child in children:
+      child_predicates = child.step.predicates(g)
+      if child_predicates is None:
+        return None
+      predicates |= child_predicates
+    return predicates
+
+  def prefetches(self, children):
+    # Whether any of children's steps needs its candidates looked up
+    for child in children:
+      if len(child.children) > 0 or child.step.dereferences():
+        return True
+    return False
+
+  def compile(self, g):
+    # Returns a function of (candidates, selected) where candidates are
+    # matched against this node's step, and the ones that match are stored
+    # under the name of each path ending here and expanded for the next steps.
+    # The root has no step and its candidates are the starting nodes.
+    select = None
+    if self.step is not None:
+      select = compile_select(self.step, g)
+    # next steps on the in:: axis need the arcs pointing to the frontier, so
+    # they are given a frontier of their own
+    branches = []
+    for inbound in (False, True):
+      children = [child for child in self.children.itervalues() if is_inbound(child.step) == inbound]
+      if len(children) > 0:
+        branches.append((inbound, self.predicates(g, children), self.prefetches(children), [child.compile(g) for child in children]))
+    names = list(self.names)
+
+    def run(candidates, selected):
+      if select is not None:
+        candidates = select(candidates, [0] * len(candidates))[0]
+      for name in names:
+        selected[name] = candidates
+      if len(candidates) == 0:
+        return
+      for (inbound, predicates, prefetch, children) in branches:
+        frontier = [resource for resources in expand(candidates, g, True, prefetch, predicates, inbound) for resource in resources]
+        for child in children:
+          child(frontier, selected)
+
+    return run
+
+
 class LocPath:
+  kind = 'set'
+
   def __init__(self, steps = []):
     self.steps = steps
+    self.plan = None
+    self.plan_groups = None
   
   def __str__(self):
     ret = ''
@@ -525,9 +2289,17 @@ class LocPath:
 
 
   def select(self, candidates, g, context, trace = False):
+    if not trace and self.plan is not None:
+      return self.plan(candidates, context)
+
     if trace:
       print "Path: %s" % self
 
+    if len(self.steps) > 0 and is_inbound(self.steps[0]) and context is not None and not context.is_arc():
+      # a filter path starting on the in:: axis begins with the arcs pointing
+      # to the resource being filtered rather than the ones leaving it
+      candidates = self.get_candidates([context], g, False, trace, False, True)
+
     selected = []
     for i in range(0, len(self.steps)):
       step = self.steps[i]
@@ -535,9 +2307,13 @@ class LocPath:
       if trace:
         print "Path: Filtering %s candidates using %s" % (len(candidates), step)
 
-      for candidate in candidates:
-        if step.matches(candidate, g, context, trace):
-          selected.append(candidate)
+      if getattr(step, 'repeat', None) is not None:
+        match = lambda resources: [step.matches(resource, g, context, trace) for resource in resources]
+        selected = step.closure(candidates, [0] * len(candidates), match, g, trace)[0]
+      else:
+        for candidate in candidates:
+          if step.matches(candidate, g, context, trace):
+            selected.append(candidate)
 
       if trace:
         print "Path: %s resources passed the filter" % len(selected)
@@ -545,14 +2321,155 @@ class LocPath:
 
       if i < (len(self.steps) - 2):
         # get a distinct list of candidates (an optimisation)
-        candidates = self.get_candidates(selected, g, True, trace)
+        candidates = self.get_candidates(selected, g, True, trace, True, is_inbound(self.steps[i + 1]))
       elif i == (len(self.steps) - 2):
         # next step is last so get candidates including duplicates
-        candidates = self.get_candidates(selected, g, True, trace)
+        candidates = self.get_candidates(selected, g, True, trace, self.steps[i + 1].dereferences(), is_inbound(self.steps[i + 1]))
 
     return selected
 
-  def get_candidates(self, resources, g, distinct = True, trace = False):
+  def compile(self, g):
+    # Flatten the steps into a list of functions that each take the whole
+    # frontier and return the resources that matched, with their tags
+    selects = [compile_select(step, g) for step in self.steps]
+    prefetches = [True] * len(self.steps)
+    if len(self.steps) > 0:
+      prefetches[-1] = self.steps[-1].dereferences()
+    # when a step can only match arcs for particular properties, generate
+    # only those arcs instead of every arc of a node
+    predicates = [step.predicates(g) for step in self.steps]
+    inbound = [is_inbound(step) for step in self.steps]
+    last = len(self.steps) - 1
+
+    def select_groups(groups):
+      # Evaluate the path from several groups of candidates at once, keeping
+      # track of the group each resource in the frontier came from
+      tags = [i for i in xrange(len(groups)) for candidate in groups[i]]
+      candidates = [candidate for group in groups for candidate in group]
+      for i in xrange(len(selects)):
+        (candidates, tags) = selects[i](candidates, tags)
+        if i < last:
+          children = expand(candidates, g, True, prefetches[i + 1], predicates[i + 1], inbound[i + 1])
+          tags = [tag for (tag, resources) in izip(tags, children) for resource in resources]
+          candidates = [resource for resources in children for resource in resources]
+
+      selected = [[] for group in groups]
+      for (tag, candidate) in izip(tags, candidates):
+        selected[tag].append(candidate)
+      return selected
+
+    def iterate(candidates, i=0, visited=None, prune=True):
+      # Evaluate the path depth first, yielding each selected resource as soon
+      # as it is found. Only the candidates reached from one resource are
+      # matched and looked up at a time, in chunks that double in size, so a
+      # caller that stops early never fetches the rest. When pruning, a
+      # resource already followed from a step is not followed again since
+      # everything it leads to has been yielded; otherwise resources are
+      # yielded as many times as select_groups would select them.
+      if visited is None:
+        visited = set()
+      size = 1
+      if getattr(self.steps[i], 'repeat', None) is not None:
+        # a repeated step is expanded breadth first from all its candidates
+        size = len(candidates)
+      start = 0
+      while start < len(candidates):
+        chunk = candidates[start:start + size]
+        start += size
+        size *= 2
+        if prefetches[i]:
+          uris = [c.value for c in chunk if not c.is_arc() and c.is_uri()]
+          if len(uris) > 0:
+            g.lookup_many(uris)
+        for candidate in selects[i](chunk, [0] * len(chunk))[0]:
+          if i == last:
+            yield candidate
+            continue
+          if prune:
+            key = (i, location_key(candidate))
+            if key in visited:
+              continue
+            visited.add(key)
+          for selected in iterate(expand([candidate], g, True, False, predicates[i + 1], inbound[i + 1])[0], i + 1, visited, prune):
+            yield selected
+
+    def begin(candidates, context):
+      # The candidates for the first step when the path is evaluated from
+      # context: its inbound arcs if the first step is on the in:: axis
+      if len(inbound) > 0 and inbound[0] and context is not None and not context.is_arc():
+        return expand([context], g, True, False, predicates[0], True)[0]
+      return candidates
+
+    def plan(candidates, context):
+      return select_groups([begin(candidates, context)])[0]
+
+    plan.iterate = iterate
+    plan.begin = begin
+    plan.select_groups = select_groups
+    plan.predicates = None
+    plan.inbound = False
+    if len(predicates) > 0:
+      plan.predicates = predicates[0]
+      plan.inbound = inbound[0]
+    self.plan = plan
+    self.plan_groups = select_groups
+    return plan
+
+  def needs_data(self):
+    return True
+
+  def cost(self):
+    cost = 0
+    last = len(self.steps) - 1
+    for i in xrange(len(self.steps)):
+      cost += estimate_cost(self.steps[i])
+      if i > 0 and (i < last or self.steps[i].dereferences()):
+        # the candidates for this step are looked up before it is matched
+        cost += LOOKUP_COST
+    return cost
+
+  def count(self, candidates, g, context, limit = None, trace = False):
+    # The number of resources select would return, counting no further than
+    # limit. With a limit the path is evaluated depth first and stops as soon
+    # as limit resources are found.
+    if limit is None or trace or len(self.steps) == 0 or any(getattr(step, 'repeat', None) is not None for step in self.steps):
+      # repeated steps are expanded from a whole frontier at a time, so they
+      # can select a resource a different number of times depth first
+      selected = self.select(candidates, g, context, trace)
+      if limit is None:
+        return len(selected)
+      return min(len(selected), limit)
+
+    if self.plan is None:
+      self.compile(g)
+    count = 0
+    if limit > 0:
+      for resource in self.plan.iterate(self.plan.begin(candidates, context), prune=False):
+        count += 1
+        if count >= limit:
+          break
+    return count
+
+  def exists(self, candidates, g, context, trace = False):
+    # Whether select would return anything, stopping at the first resource
+    if trace or len(self.steps) == 0:
+      return len(self.select(candidates, g, context, trace)) > 0
+    if self.plan is None:
+      self.compile(g)
+    for resource in self.plan.iterate(self.plan.begin(candidates, context)):
+      return True
+    return False
+
+  def compile_many(self, g):
+    if self.plan is None:
+      self.compile(g)
+    if len(self.steps) > 0 and is_inbound(self.steps[0]):
+      # start from the arcs pointing to each node being filtered
+      predicates = self.steps[0].predicates(g)
+      return lambda groups, contexts: self.plan_groups(expand(contexts, g, True, False, predicates, True))
+    return lambda groups, contexts: self.plan_groups(groups)
+
+  def get_candidates(self, resources, g, distinct = True, trace = False, prefetch = False, inbound = False):
       
     candidates = []
     for resource in resources:
@@ -562,6 +2479,11 @@ class LocPath:
             print "Path: Selecting nodes that are values of %s" % resource
             
           candidates.extend(resource.get_nodes())
+        elif inbound:
+          if trace:
+            print "Path: Selecting arcs that point to %s" % resource
+
+          candidates.extend(resource.get_arcs(resource, inbound=True))
         else:
           if trace:
             print "Path: Selecting arcs that are properties of %s" % resource
@@ -570,6 +2492,15 @@ class LocPath:
 
     if trace:
       print "Path: Selected %s candidates" % len(candidates)
+
+    if prefetch:
+      # look up every node in the frontier at once rather than one by one as
+      # each is matched
+      uris = [c.value for c in candidates if not c.is_arc() and c.is_uri()]
+      if len(uris) > 0:
+        if trace:
+          print "Path: Looking up %s candidate nodes" % len(uris)
+        g.lookup_many(uris)
       
     return candidates
 
@@ -579,6 +2510,15 @@ class WildCardMatcher:
   def __str__(self):
     return '*'
 
+  def dereferences(self):
+    return False
+
+  def predicates(self, g):
+    return None
+
+  def compile(self, g):
+    return lambda candidates: [True] * len(candidates)
+
   def matches(self, candidate, g, context, trace = False):
     if trace:
       print "WildCardMatcher: Automatically matching %s" % (candidate)
@@ -593,6 +2533,28 @@ class TypeMatcher:
   def __str__(self):
     return self.type
 
+  def dereferences(self):
+    return True
+
+  def predicates(self, g):
+    test_uri = g.qname_to_uri(self.type)
+    if test_uri:
+      return set([test_uri])
+    return set()
+
+  def compile(self, g):
+    test_uri = g.qname_to_uri(self.type)
+    if not test_uri:
+      return lambda candidates: [False] * len(candidates)
+
+    def match(candidates):
+      nodes = [candidate.value for candidate in candidates if not candidate.is_arc()]
+      typed = ()
+      if len(nodes) > 0:
+        typed = g.get_typed_subjects(nodes, test_uri)
+      return [candidate.value == test_uri if candidate.is_arc() else candidate.value in typed for candidate in candidates]
+    return match
+
   def matches(self,candidate,g, context, trace = False):
     if trace:
       print "TypeMatcher: Testing %s using %s" % (candidate, self);
@@ -627,10 +2589,14 @@ class TypeMatcher:
     return it_matches
 
 class StepMatcher:
-  def __init__(self, selector, axis, filters):
+  def __init__(self, selector, axis, filters, repeat = None):
     self.selector = selector
     self.axis = axis
     self.filters = filters
+    self.repeat = repeat
+    # filters, and the operands of filters joined by and, are tested cheapest
+    # first, stopping at the first that fails
+    self.ordered_filters = sorted([c for filter in filters for c in conjuncts(filter)], key=estimate_cost)
 
   def __str__(self):
     ret = '';
@@ -638,11 +2604,172 @@ class StepMatcher:
       ret += self.axis + '::'
 
     ret += str(self.selector)
+    if self.repeat is not None:
+      (least, most) = self.repeat
+      if least == 1 and most is None:
+        ret += '+'
+      elif least == most:
+        ret += '{%s}' % least
+      elif most is None:
+        ret += '{%s,}' % least
+      else:
+        ret += '{%s,%s}' % (least, most)
     for filter in self.filters:
       ret += "[" + str(filter) + "]"
       
     return ret;
 
+  def dereferences(self):
+    # Whether matching a node against this step needs data about that node.
+    # When the first filter tested only needs the node itself, as uri(.) does,
+    # the nodes it rules out are never looked up.
+    if self.selector.dereferences():
+      return True
+    return len(self.ordered_filters) > 0 and needs_data(self.ordered_filters[0])
+
+  def predicates(self, g):
+    # The set of properties of the arcs this step can match, or None if it
+    # can match any arc
+    return self.selector.predicates(g)
+
+  def cost(self):
+    cost = 1 + sum(estimate_cost(filter) for filter in self.filters)
+    if self.repeat is not None:
+      # the nodes between repeats are looked up
+      cost += LOOKUP_COST
+    return cost
+
+  def compile_closure(self, g):
+    match = self.compile(g)
+    return lambda candidates, tags: self.closure(candidates, tags, match, g)
+
+  def closure(self, candidates, tags, match, g, trace = False):
+    # Repeat this step breadth first from candidates, the arcs of the first
+    # repeat, matching each frontier of arcs with match and following the ones
+    # that match to the arcs of the nodes they lead to. Returns the arcs
+    # matched between the least and most repeats and their tags. Each node is
+    # expanded at most once for each tag and each number of repeats below
+    # least, and once more from least onwards, where reaching it again by a
+    # longer path can only find arcs already found. This includes the nodes
+    # the candidates start from, reached after no repeats. Reaching
+    # MAX_CLOSURE_DEPTH or MAX_CLOSURE_NODES stops the closure and marks the
+    # query's results incomplete.
+    (least, most) = self.repeat
+    predicates = self.predicates(g)
+    inbound = is_inbound(self)
+    visited = set((tag, candidate.node, 0) for (tag, candidate) in izip(tags, candidates))
+    expanded = {}
+    truncated = False
+    selected = []
+    selected_tags = []
+    depth = 1
+    while len(candidates) > 0:
+      mask = match(candidates)
+      tags = [tag for (tag, matched) in izip(tags, mask) if matched]
+      candidates = [candidate for (candidate, matched) in izip(candidates, mask) if matched]
+      if trace:
+        print "StepMatcher: %s arcs matched %s after %s repeats" % (len(candidates), self, depth)
+      if depth >= least:
+        selected.extend(candidates)
+        selected_tags.extend(tags)
+      if most is not None and depth >= most:
+        break
+      if depth >= MAX_CLOSURE_DEPTH:
+        truncated = len(candidates) > 0
+        break
+
+      nodes = []
+      node_tags = []
+      for (tag, children) in izip(tags, expand(candidates, g)):
+        for node in children:
+          key = (tag, node.value, min(depth, least))
+          if node.is_literal() or key in visited:
+            continue
+          if expanded.get(tag, 0) >= MAX_CLOSURE_NODES:
+            truncated = True
+            continue
+          visited.add(key)
+          expanded[tag] = expanded.get(tag, 0) + 1
+          nodes.append(node)
+          node_tags.append(tag)
+
+      children = expand(nodes, g, True, False, predicates, inbound)
+      tags = [tag for (tag, arcs) in izip(node_tags, children) for arc in arcs]
+      candidates = [arc for arcs in children for arc in arcs]
+      depth += 1
+
+    if truncated:
+      if trace:
+        print "StepMatcher: Stopped repeating %s at the closure limits" % self
+      memo = g.get_memo()
+      if memo is not None:
+        memo.truncated = True
+      limits = g.get_limits()
+      if limits is not None:
+        limits.complete = False
+    return (selected, selected_tags)
+
+  def compile(self, g):
+    select = self.selector.compile(g)
+    if len(self.filters) == 0:
+      return select
+
+    filters = [(filter, filter.compile(g), needs_data(filter)) for filter in self.ordered_filters]
+
+    def match_distinct(candidates):
+      mask = select(candidates)
+      passing = [i for i in xrange(len(candidates)) if mask[i]]
+      memo = g.get_memo()
+      # the resources each candidate leads to, only found for candidates a
+      # filter that reads them has to be tested against
+      groups = {}
+      for (expr, filter, reads) in filters:
+        if len(passing) == 0:
+          break
+        results = {}
+        todo = passing
+        if memo is not None:
+          todo = []
+          for i in passing:
+            matched = memo.get(expr, candidates[i])
+            if matched is None:
+              todo.append(i)
+            else:
+              results[i] = matched
+
+        if len(todo) > 0:
+          if reads:
+            needed = [i for i in todo if i not in groups]
+            for (i, group) in izip(needed, expand([candidates[i] for i in needed], g)):
+              groups[i] = group
+          for (i, matched) in izip(todo, filter([groups.get(i, []) for i in todo], [candidates[i] for i in todo])):
+            results[i] = matched
+            if memo is not None:
+              memo.put(expr, candidates[i], matched)
+
+        for i in passing:
+          if not results[i]:
+            mask[i] = False
+        passing = [i for i in passing if results[i]]
+      return mask
+
+    def match(candidates):
+      # A frontier often holds the same resource many times over, reached by
+      # different routes. Test each resource once and share the result.
+      index = {}
+      distinct = []
+      positions = []
+      for candidate in candidates:
+        key = location_key(candidate)
+        i = index.get(key)
+        if i is None:
+          i = index[key] = len(distinct)
+          distinct.append(candidate)
+        positions.append(i)
+      mask = match_distinct(distinct)
+      return [mask[i] for i in positions]
+    return match
+
   def matches(self, candidate, g, context, trace = False):
     if trace:
       print "StepMatcher: Matching %s using %s" % (candidate, self)
@@ -652,18 +2779,32 @@ class StepMatcher:
       if len(self.filters) == 0:
         it_matches = True
       else:
-        filter_passes = 0
-        filter_resources = self.get_candidates([candidate], g, trace)
+        it_matches = True
+        # only found once a filter that reads them is tested
+        filter_resources = None
         
-        for filter in self.filters:
+        memo = g.get_memo()
+        for filter in self.ordered_filters:
           if trace:
             print "StepMatcher: Applying filter %s" % filter
-            
-          if filter.matches(filter_resources, g, candidate, trace):
-            filter_passes += 1
-          
-        if filter_passes == len(self.filters):
-          it_matches = True;
+
+          matched = None
+          if memo is not None:
+            matched = memo.get(filter, candidate)
+            if trace and matched is not None:
+              print "StepMatcher: Using the remembered result of %s for %s" % (filter, candidate)
+          if matched is None:
+            if filter_resources is None and needs_data(filter):
+              filter_resources = self.get_candidates([candidate], g, trace)
+            matched = filter.matches(filter_resources or [], g, candidate, trace)
+            if memo is not None:
+              memo.put(filter, candidate, matched)
+
+          if not matched:
+            if trace:
+              print "StepMatcher: Not testing the remaining filters"
+            it_matches = False
+            break
 
     if trace:
       if it_matches:
@@ -701,7 +2842,18 @@ class LiteralMatcher:
 
   def __str__(self):
     return "'%s'" % self.text
-    
+
+  def dereferences(self):
+    return False
+
+  def predicates(self, g):
+    # arcs are never literals
+    return set()
+
+  def compile(self, g):
+    text = self.text
+    return lambda candidates: [candidate.is_literal() and str(candidate.value) == text for candidate in candidates]
+
   def matches(self, candidate, g, context, trace = False):
     if trace:
       print "LiteralMatcher: Testing %s using %s" % (candidate, self)
@@ -728,7 +2880,16 @@ class LiteralMatcher:
 class AnyLiteralMatcher:
   def __str__(self):
     return "text()"
-  
+
+  def dereferences(self):
+    return False
+
+  def predicates(self, g):
+    return set()
+
+  def compile(self, g):
+    return lambda candidates: [candidate.is_literal() for candidate in candidates]
+
   def matches(self, candidate, g, context, trace = False):
     if trace:
       print "AnyLiteralMatcher: Testing %s using %s" % (candidate, self)
@@ -750,6 +2911,8 @@ class AnyLiteralMatcher:
     return it_matches
 
 class LiteralHolder:
+  kind = 'string'
+
   def __init__(self, text, dt = None):
     self.text = text
     self.dt = dt
@@ -762,6 +2925,8 @@ class LiteralHolder:
 
 
 class NumberHolder:
+  kind = 'number'
+
   def __init__(self, num):
     self.number = float(num) # TODO test for NaN
 
@@ -774,6 +2939,8 @@ class NumberHolder:
 
 
 class SelfHolder:
+  kind = 'set'
+
   def __str__(self):
     return "."
 
@@ -782,6 +2949,8 @@ class SelfHolder:
 
 
 class BooleanHolder:
+  kind = 'boolean'
+
   def __init__(self, val):
     self.value = val
 
@@ -800,6 +2969,15 @@ class CompExpr:
     self.left = left
     self.operator = op
     self.right = right
+    if op and right:
+      self.limit_count(left, right)
+      self.limit_count(right, left)
+
+  def limit_count(self, count, other):
+    # Comparing count(x) with a number k gives the same result when no more
+    # than floor(k) + 1 resources are counted
+    if isinstance(count, CountFunction) and isinstance(other, NumberHolder):
+      count.limit = max(int(math.floor(other.number)) + 1, 0)
 
   def __str__(self):
     ret = str(self.left)
@@ -809,11 +2987,30 @@ class CompExpr:
 
 
   def matches(self, candidates, g, context, trace = False):
+    memo = None
+    if context is not None:
+      memo = g.get_memo()
+    if memo is not None:
+      it_matches = memo.get(self, context)
+      if it_matches is not None:
+        if trace:
+          print "CompExpr: Using the remembered result of %s for %s" % (self, context)
+        return it_matches
+
     it_matches = False
 
     if trace:
       print "CompExpr: Selecting resources using left of %s, op of %s and right of %s " % (self.left, self.operator, self.right)
       
+    if not (self.operator and self.right) and isinstance(self.left, PathFunction):
+      # a path on its own only has to select one resource
+      it_matches = self.left.exists(candidates, g, context, trace)
+      if trace:
+        print "CompExpr: %s using %s" % ("MATCHED" if it_matches else "NO MATCH", self)
+      if memo is not None:
+        memo.put(self, context, it_matches)
+      return it_matches
+
     selected = self.left.evaluate(candidates, g, context, trace);
  
     if self.operator and self.right:
@@ -821,91 +3018,7 @@ class CompExpr:
         print "CompExpr: Selecting resources using right of %s" % self.right
         
       selected_right = self.right.evaluate(candidates, g, context, trace)
-
-      
-      if type(selected) == list:
-        if trace:
-          print "CompExpr: Left of comparison selected a set of %s resources" % len(selected)
-
-        if type(selected_right) == list:
-          if trace:
-            print "CompExpr: Right of comparison selected a set of  %s resources" % len(selected_right)
-          it_matches = self.compare_list_to_list(selected, selected_right);
-        elif type(selected_right) == bool:
-          if trace:
-            print "CompExpr: Right of comparison selected a boolean of value %s" % selected_right
-          it_matches = self.compare_list_to_boolean(selected, selected_right);
-        elif type(selected_right) == int or  type(selected_right) == float:
-          if trace:
-            print "CompExpr: Right of comparison selected a number of value %s" % selected_right
-          it_matches = self.compare_list_to_numeric(selected, selected_right);
-        elif type(selected_right) == str or type(selected_right) == unicode:
-          if trace:
-            print "CompExpr: Right of comparison selected a string of value %s" % selected_right
-          it_matches = self.compare_list_to_string(selected, selected_right);
-      elif type(selected) == bool:
-        if trace:
-          print "CompExpr: Left of comparison selected a boolean of value %s" % selected
-
-        if type(selected_right) == list:
-          if trace:
-            print "CompExpr: Right of comparison selected a set of %s resources" % len(selected_right)
-          it_matches = self.compare_list_to_boolean(selected_right, selected);
-        elif type(selected_right) == bool:
-          if trace:print "CompExpr: Right of comparison selected a boolean of value %s" % selected_right
-          if (selected_right == True and selected == True) or (selected_right == False and selected == False):
-            it_matches = True
-        elif type(selected_right) == int or  type(selected_right) == float:
-          if trace:
-            print "CompExpr: Right of comparison selected a number of value %s" % selected_right
-          # TODO
-        elif type(selected_right) == str or type(selected_right) == unicode:
-          if trace:print "CompExpr: Right of comparison selected a string of value " % selected_right
-          it_matches = self.compare_boolean_to_string(selected, selected_right);
-      elif type(selected) == int or type(selected) == float:
-        if trace:print "CompExpr: Left of comparison selected a number of value %s" % selected
-        if type(selected_right) == list:
-          if trace:
-            print "CompExpr: Right of comparison selected a set of %s resources" % len(selected_right)
-          it_matches = self.compare_list_to_numeric(selected_right, selected);
-        elif type(selected_right) == bool:
-          if trace:
-            print "CompExpr: Right of comparison selected a boolean of value %s" % selected_right
-          # TODO
-        elif type(selected_right) == int or  type(selected_right) == float:
-          if trace:
-            print "CompExpr: Right of comparison selected a number of value %s" % selected_right
-          
-          it_matches = self.compare_numerics(selected, selected_right)
-        elif type(selected_right) == str or type(selected_right) == unicode:
-          if trace:
-            print "CompExpr: Right of comparison selected a string of value %s" % selected_right
-          # TODO
-      elif type(selected) == str or type(selected) == unicode:
-
-        if trace:
-          print "CompExpr: Left of comparison selected a string of value %s" % selected_right
-        
-        if type(selected_right) == list:
-          if trace:
-            print "CompExpr: Right of comparison selected a set of %s resources" % len(selected_right)
-          it_matches = self.compare_list_to_string(selected_right, selected);
-        elif type(selected_right) == bool:
-          if trace:
-            print "CompExpr: Right of comparison selected a boolean of value " % selected_right
-          it_matches = self.compare_boolean_to_string(selected_right, selected);
-        elif type(selected_right) == int or  type(selected_right) == float:
-          if trace:
-            print "CompExpr: Right of comparison selected a number of value %s" % selected_right
-          # TODO
-        elif type(selected_right) == str or type(selected_right) == unicode:
-          if trace:
-            print "CompExpr: Right of comparison selected a string of value %s" % selected_right
-          
-          if self.operator == '=' and selected == selected_right:
-            it_matches = True
-          elif self.operator == '!=' and selected != selected_right:
-            it_matches = True
+      it_matches = self.compare(selected, selected_right, trace)
 
     else:
       if trace:
@@ -919,9 +3032,57 @@ class CompExpr:
         print "CompExpr: MATCHED using %s" % self
       else:
         print "CompExpr: NO MATCH using %s" % self
-    
+
+    if memo is not None:
+      memo.put(self, context, it_matches)
     return it_matches
 
+  def cost(self):
+    cost = estimate_cost(self.left)
+    if self.operator and self.right:
+      cost += estimate_cost(self.right)
+    return cost
+
+  def needs_data(self):
+    return needs_data(self.left) or bool(self.operator and self.right and needs_data(self.right))
+
+  def compile(self, g):
+    # Returns a function of (groups, contexts) that tests each group of
+    # resources, returning a list of booleans
+    left = compile_many(self.left, g)
+    if self.operator and self.right:
+      right = compile_many(self.right, g)
+      left_kind = getattr(self.left, 'kind', None)
+      right_kind = getattr(self.right, 'kind', None)
+      if left_kind and right_kind:
+        # the kinds of value on each side are known, so pick the comparison now
+        batch = self.batch_comparisons.get((left_kind, right_kind))
+        if batch is not None:
+          return lambda groups, contexts: batch(self, left(groups, contexts), right(groups, contexts))
+        comparison = self.comparisons.get((left_kind, right_kind))
+        if comparison is None:
+          return lambda groups, contexts: [False] * len(groups)
+        compare = lambda selected, selected_right: comparison(self, selected, selected_right)
+      else:
+        compare = self.compare
+      return lambda groups, contexts: map(compare, left(groups, contexts), right(groups, contexts))
+
+    if isinstance(self.left, PathFunction):
+      return self.left.compile_exists(g)
+    bool_value = self.bool_value
+    return lambda groups, contexts: map(bool_value, left(groups, contexts))
+
+  def compare(self, selected, selected_right, trace = False):
+    left_kind = KINDS.get(type(selected))
+    right_kind = KINDS.get(type(selected_right))
+    if trace:
+      print "CompExpr: Comparing a %s of value %s with a %s of value %s" % (left_kind, selected, right_kind, selected_right)
+
+    comparison = self.comparisons.get((left_kind, right_kind))
+    if comparison is None:
+      return False
+    return comparison(self, selected, selected_right)
+
   def compare_numerics(self, left, right):
     if self.operator == '=' and left == right:
       return True
@@ -972,8 +3133,9 @@ class CompExpr:
 
   def compare_list_to_numeric(self, list1, numeric):
     for resource in list1:
-      if resource.is_literal() and isnumeric(str(resource.value)):
-        if self.compare_numerics(float(resource.value), numeric):
+      if resource.is_literal():
+        number = resource.g.literal_value(resource.value)[1]
+        if number is not None and self.compare_numerics(number, numeric):
           return True
 
     return False
@@ -984,14 +3146,15 @@ class CompExpr:
 
     for resource in list1:
       if resource.is_literal():
-        if (self.operator == '=' and str(resource.value) == string):
+        value = resource.g.literal_value(resource.value)[0]
+        if (self.operator == '=' and value == string):
           return True
-        elif (self.operator == '!=' and str(resource.value) != string):
+        elif (self.operator == '!=' and value != string):
           return True
 
     return False
 
-  def compare_boolean_to_string(boolean, string):
+  def compare_boolean_to_string(self, boolean, string):
     if self.operator != '=':
       return False
 
@@ -999,16 +3162,87 @@ class CompExpr:
       string_bool = True
     else:
       string_bool = False
-    if (list_bool == True and boolean == True) or (list_bool == False and boolean == False):
+    if (string_bool == True and boolean == True) or (string_bool == False and boolean == False):
       return True
     else:
       return False
 
+  def compare_strings(self, left, right):
+    if self.operator == '=' and left == right:
+      return True
+    elif self.operator == '!=' and left != right:
+      return True
+
+    return False
+
+  def compare_lists_to_numerics(self, lists, numerics):
+    # Compare each list of resources with the number at the same position,
+    # returning a list of booleans. The numbers of every literal in the lists
+    # are compared at once.
+    values = []
+    owners = []
+    for i in xrange(len(lists)):
+      for resource in lists[i]:
+        if isinstance(resource.value, Literal):
+          number = resource.g.literal_value(resource.value)[1]
+          if number is not None:
+            values.append(number)
+            owners.append(i)
+
+    if numpy is not None and len(values) >= VECTOR_THRESHOLD:
+      owners = numpy.array(owners, dtype=int)
+      matched = self.vector_operators[self.operator](numpy.array(values, dtype=float), numpy.array(numerics, dtype=float)[owners])
+      results = numpy.zeros(len(lists), dtype=bool)
+      results[owners[matched]] = True
+      return results.tolist()
+
+    results = [False] * len(lists)
+    for (value, i) in izip(values, owners):
+      if not results[i] and self.compare_numerics(value, numerics[i]):
+        results[i] = True
+    return results
+
+  def compare_numerics_many(self, lefts, rights):
+    if numpy is not None and len(lefts) >= VECTOR_THRESHOLD:
+      return self.vector_operators[self.operator](numpy.array(lefts, dtype=float), numpy.array(rights, dtype=float)).tolist()
+    return map(self.compare_numerics, lefts, rights)
+
+  vector_operators = {}
+  if numpy is not None:
+    vector_operators = {'=': numpy.equal, '!=': numpy.not_equal, '<': numpy.less, '>': numpy.greater, '<=': numpy.less_equal, '>=': numpy.greater_equal}
+
+  # Comparisons made for a whole frontier at once, taking a list of values
+  # for each side
+  batch_comparisons = {
+    ('set', 'number'): compare_lists_to_numerics,
+    ('number', 'set'): lambda self, lefts, rights: self.compare_lists_to_numerics(rights, lefts),
+    ('number', 'number'): compare_numerics_many,
+  }
+
+  # How to compare each kind of value on the left with each kind on the
+  # right. Pairs that are missing never match.
+  comparisons = {
+    ('set', 'set'): compare_list_to_list,
+    ('set', 'boolean'): compare_list_to_boolean,
+    ('set', 'number'): compare_list_to_numeric,
+    ('set', 'string'): compare_list_to_string,
+    ('boolean', 'set'): lambda self, left, right: self.compare_list_to_boolean(right, left),
+    ('boolean', 'boolean'): compare_booleans,
+    ('boolean', 'string'): compare_boolean_to_string,
+    ('number', 'set'): lambda self, left, right: self.compare_list_to_numeric(right, left),
+    ('number', 'number'): compare_numerics,
+    ('string', 'set'): lambda self, left, right: self.compare_list_to_string(right, left),
+    ('string', 'boolean'): lambda self, left, right: self.compare_boolean_to_string(right, left),
+    ('string', 'string'): compare_strings,
+  }
+
     
 class OrExpr:
   def __init__(self, left, right = None):
     self.left = left
     self.right = right
+    # operands are tested cheapest first, stopping at the first that matches
+    self.operands = sorted(flatten_operands(self, OrExpr), key=estimate_cost)
 
   def __str__(self):
     ret = str(self.left)
@@ -1023,10 +3257,10 @@ class OrExpr:
 
     it_matches = False
 
-    if self.left.matches(candidates, g, context, trace):
-      it_matches = True
-    elif self.right and self.right.matches(candidates, g, context, trace):
-      it_matches = True
+    for operand in self.operands:
+      if operand.matches(candidates, g, context, trace):
+        it_matches = True
+        break
 
     if trace:
       if it_matches:
@@ -1036,11 +3270,22 @@ class OrExpr:
     
     return it_matches
 
+  def cost(self):
+    return sum(estimate_cost(operand) for operand in self.operands)
+
+  def needs_data(self):
+    return any(needs_data(operand) for operand in self.operands)
+
+  def compile(self, g):
+    return compile_operands(self.operands, g, False)
+
 
 class AndExpr:
   def __init__(self, left, right = None):
     self.left = left
     self.right = right
+    # operands are tested cheapest first, stopping at the first that fails
+    self.operands = sorted(flatten_operands(self, AndExpr), key=estimate_cost)
 
   def __str__(self):
     ret = str(self.left)
@@ -1052,14 +3297,12 @@ class AndExpr:
   def matches(self, candidates, g, context, trace = False):
     if trace:
       print "AndExpr: Selecting resources using left of %s, right of %s" % (self.left, self.right)
-    it_matches = False
+    it_matches = True
 
-    if self.left.matches(candidates, g, context, trace):
-      if self.right:
-        if self.right.matches(candidates, g, context, trace):
-          it_matches = True
-      else:
-        it_matches = True
+    for operand in self.operands:
+      if not operand.matches(candidates, g, context, trace):
+        it_matches = False
+        break
 
     if trace:
       if it_matches:
@@ -1069,8 +3312,60 @@ class AndExpr:
     
     return it_matches
 
+  def cost(self):
+    return sum(estimate_cost(operand) for operand in self.operands)
+
+  def needs_data(self):
+    return any(needs_data(operand) for operand in self.operands)
+
+  def compile(self, g):
+    return compile_operands(self.operands, g, True)
+
+
+def flatten_operands(expr, cls):
+  # The operands of a chain of and or or expressions such as a and (b and c)
+  operands = []
+  for operand in (expr.left, expr.right):
+    if isinstance(operand, cls):
+      operands.extend(operand.operands)
+    elif operand:
+      operands.append(operand)
+  return operands
+
+
+def conjuncts(expr):
+  # The expressions that must all match for expr to match: the operands of an
+  # and, looking through the or and and expressions that wrap a single operand
+  if isinstance(expr, (OrExpr, AndExpr)) and len(expr.operands) == 1:
+    return conjuncts(expr.operands[0])
+  if isinstance(expr, AndExpr):
+    return [c for operand in expr.operands for c in conjuncts(operand)]
+  return [expr]
+
+
+def compile_operands(operands, g, conjunction):
+  # Compile the operands of an and (when conjunction is True) or an or,
+  # testing each group only against the operands that can still change the
+  # outcome
+  compiled = [operand.compile(g) for operand in operands]
+  if len(compiled) == 1:
+    return compiled[0]
+
+  def match(groups, contexts):
+    mask = compiled[0](groups, contexts)
+    for operand in compiled[1:]:
+      undecided = [i for i in xrange(len(mask)) if bool(mask[i]) == conjunction]
+      if len(undecided) == 0:
+        break
+      for (i, matched) in izip(undecided, operand([groups[i] for i in undecided], [contexts[i] for i in undecided])):
+        mask[i] = matched
+    return mask
+  return match
+
 
 class PathFunction:
+  kind = 'set'
+
   def __init__(self, arg):
     self.arg = arg;
 
@@ -1085,10 +3380,36 @@ class PathFunction:
     # TODO: ensure value is a nodeset
     return self.arg.select(value, g, context, trace)
 
+  def count(self, value, g, context, limit = None, trace = False):
+    return self.arg.count(value, g, context, limit, trace)
+
+  def exists(self, value, g, context, trace = False):
+    return self.arg.exists(value, g, context, trace)
+
+  def compile_many(self, g):
+    return self.arg.compile_many(g)
+
+  def compile_exists(self, g):
+    # Returns a function of (groups, contexts) that tests whether the path
+    # selects anything from each group, stopping at the first resource
+    self.arg.compile_many(g)
+    return lambda groups, contexts: [self.arg.exists(group, g, context) for (group, context) in izip(groups, contexts)]
+
 
 class CountFunction:
+  kind = 'number'
+
   def __init__(self, arg):
     self.arg = arg;
+    # counting stops at limit when that is enough to decide a comparison
+    self.limit = None
+
+  def compile_many(self, g):
+    arg = compile_many(self.arg, g)
+    if self.limit is not None and isinstance(self.arg, PathFunction):
+      limit = self.limit
+      return lambda groups, contexts: [self.arg.count(group, g, context, limit) for (group, context) in izip(groups, contexts)]
+    return lambda groups, contexts: [len(result) if isinstance(result, list) else 0 for result in arg(groups, contexts)]
 
   def __str__(self):
     return 'count(%s)' % self.arg
@@ -1097,6 +3418,12 @@ class CountFunction:
     if trace:
       print "CountFunction: Counting number of resources selected by %s" % self.arg
     # TODO: ensure value is a nodeset
+    if isinstance(self.arg, PathFunction):
+      count = self.arg.count(value, g, context, self.limit, trace)
+      if trace:
+        print "CountFunction: Counted %s resources" % count
+      return count
+
     result = self.arg.evaluate(value, g, context, trace)
     
     if isinstance(result, list):
@@ -1206,6 +3533,11 @@ class BooleanFunction:
     return 'boolean(%s)' % self.arg
 
   def evaluate(self, value, g, context, trace = False):
+    if isinstance(self.arg, PathFunction):
+      if trace:
+        print "BooleanFunction: Checking if %s selects anything" % self.arg
+      return self.arg.exists(value, g, context, trace)
+
     v = self.arg.evaluate(value, g, context, trace)
     if type(v) == list or type(v) == str or type(v) == unicode:
       if trace:
@@ -1,5 +1,16 @@
+import sys
 import unittest
-from LinkPath import LinkPathProcessor, AggregatingGraph
+import httplib2
+from StringIO import StringIO
+import os
+import shutil
+import socket
+import tempfile
+import marshal
+import threading
+import time
+import LinkPath
+from LinkPath import LinkPathProcessor, Node, AggregatingGraph, CompactStore, DocumentCache, FetchScheduler, NegativeCache, FetchArchive, dump_triples, load_triples
 from rdflib import Graph, URIRef, Literal, BNode, RDF, RDFS, Namespace
 from rdflib.parser import StringInputSource
 
@@ -429,6 +440,369 @@ class TestLinkPathProcessor(unittest.TestCase):
     assert URIRef("http://example.com/res/person4") in res, "was expecting http://example.com/res/person4 in result list"
 
 
+  def test_aselect(self):
+    wp = self.make_processor(self.foaf_data)
+    finished = []
+    future = wp.aselect('http://example.com/res/person1', "foaf:knows/*/foaf:givenName/text()", finished.append)
+    res = future.result(10)
+    assert len(res) == 3, "was expecting 3 results"
+    assert finished == [future], "was expecting callback to receive the future"
+
+  def test_aselect_concurrent_queries(self):
+    wp = self.make_processor(self.foaf_data)
+    futures = [wp.aselect('http://example.com/res/person1', "foaf:knows/*[foaf:age/text() > 32]") for i in range(20)]
+    for future in futures:
+      assert future.result(10) == [URIRef("http://example.com/res/person3")], "was expecting http://example.com/res/person3"
+
+  def test_compiled_paths_are_cached(self):
+    wp = self.make_processor(self.foaf_data)
+    path = "foaf:knows/*[foaf:age/text() > 32]/foaf:givenName/text()"
+    first = wp.select('http://example.com/res/person1', path)
+    second = wp.select('http://example.com/res/person2', path)
+    assert first == [Literal("Jenny")], "was expecting Jenny"
+    assert wp.plans.misses == 1, "was expecting the path to be compiled once"
+    assert wp.plans.hits == 1, "was expecting the second select to reuse the plan"
+
+  def test_rebinding_prefix_recompiles_path(self):
+    wp = self.make_processor(self.foaf_data)
+    res = wp.select('http://example.com/res/person1', "f:knows/*")
+    assert len(res) == 0, "was expecting no results for an unbound prefix"
+    wp.bind("f", "http://xmlns.com/foaf/0.1/")
+    res = wp.select('http://example.com/res/person1', "f:knows/*")
+    assert len(res) == 3, "was expecting 3 results once the prefix is bound"
+
+  def test_traced_and_compiled_paths_agree(self):
+    wp = self.make_processor(self.foaf_data)
+    path = "foaf:knows/*[foaf:age/text() > 32 or foaf:givenName/text() = 'Emily']"
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+      traced = wp.select('http://example.com/res/person1', path, trace=True)
+    finally:
+      sys.stdout = stdout
+    assert sorted(traced) == sorted(wp.select('http://example.com/res/person1', path)), "was expecting the same results with and without trace"
+
+  def test_iselect(self):
+    wp = self.make_processor(self.foaf_data)
+    res = list(wp.iselect('http://example.com/res/person1', "foaf:knows/*/foaf:knows/*/foaf:givenName/text()"))
+    assert sorted(res) == sorted(wp.select('http://example.com/res/person1', "foaf:knows/*/foaf:knows/*/foaf:givenName/text()")), "was expecting the same results as select"
+    assert len(res) == len(set(res)), "was expecting distinct results"
+
+  def test_iselect_limit_stops_lookups(self):
+    wp = self.make_processor(self.foaf_data)
+    res = list(wp.iselect('http://example.com/res/person1', "foaf:knows/*/foaf:based_near/*/foaf:name/text()", limit=1))
+    assert len(res) == 1, "was expecting 1 result"
+    other = {"London": "http://example.com/res/place2", "Brighton": "http://example.com/res/place1"}[str(res[0])]
+    assert other not in wp.g.lookup_counts, "was expecting %s not to be looked up" % other
+
+    wp = self.make_processor(self.foaf_data)
+    wp.select('http://example.com/res/person1', "foaf:knows/*/foaf:based_near/*/foaf:name/text()")
+    assert other in wp.g.lookup_counts, "was expecting select to look up %s" % other
+
+  def test_iselect_is_lazy(self):
+    wp = self.make_processor(self.foaf_data)
+    results = wp.iselect('http://example.com/res/person1', "foaf:knows/*/foaf:based_near/*/foaf:name/text()")
+    assert len(wp.g.lookup_counts) == 0, "was expecting nothing to be looked up before the first result is asked for"
+    first = str(results.next())
+    other = {"London": "http://example.com/res/place2", "Brighton": "http://example.com/res/place1"}[first]
+    assert other not in wp.g.lookup_counts, "was expecting %s not to be looked up yet" % other
+    assert len(list(results)) == 1, "was expecting one more result"
+    assert other in wp.g.lookup_counts, "was expecting %s to be looked up for the second result" % other
+
+  def test_step_property_pushed_into_graph_queries(self):
+    g = FakeAggregatingGraph()
+    d = Graph()
+    d.parse(StringInputSource(self.foaf_data), format="n3")
+    g.set_all(d)
+    queries = []
+    get_subjects_properties = g.get_subjects_properties
+    def record(subjects, distinct, predicates=None):
+      queries.append(predicates)
+      return get_subjects_properties(subjects, distinct, predicates)
+    g.get_subjects_properties = record
+    g.get_subject_properties = None
+
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*/foaf:givenName/text()")
+    assert sorted(res) == [Literal("Andrew"), Literal("Emily"), Literal("Jenny")], "was expecting the given names of friends"
+    assert queries == [set([URIRef("http://xmlns.com/foaf/0.1/knows")]), set([URIRef("http://xmlns.com/foaf/0.1/givenName")])], "was expecting only the named properties to be queried"
+
+  def test_filter_results_remembered_per_query(self):
+    wp = self.make_processor(self.foaf_data)
+    path = "foaf:knows/*/foaf:knows/*[foaf:age/text() > 30]"
+    res = wp.select('http://example.com/res/person1', path)
+    assert sorted(res) == [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")], "was expecting person2 and person3"
+    assert res.memo_misses == 4, "was expecting the filter to be tested once for each of the 4 people"
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+      traced = wp.select('http://example.com/res/person1', path, trace=True)
+    finally:
+      sys.stdout = stdout
+    assert sorted(traced) == sorted(res), "was expecting the same results with trace"
+    # each person is tested once by the step and once by its comparison
+    assert traced.memo_misses == 8, "was expecting the filter to be tested once for each of the 4 people"
+    assert traced.memo_hits > 0, "was expecting people reached more than once to use remembered results"
+
+  def test_cheap_filters_tested_first(self):
+    for path in ["foaf:knows/*[foaf:based_near/*/foaf:name/text() = 'London'][uri(.) = 'http://example.com/res/person4']",
+                 "foaf:knows/*[foaf:based_near/*/foaf:name/text() = 'London' and uri(.) = 'http://example.com/res/person4']"]:
+      for trace in (False, True):
+        wp = self.make_processor(self.foaf_data)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+          res = wp.select('http://example.com/res/person1', path, trace=trace)
+        finally:
+          sys.stdout = stdout
+        assert len(res) == 0, "was expecting no results"
+        assert "http://example.com/res/place2" in wp.g.lookup_counts, "was expecting person4's place to be looked up"
+        assert "http://example.com/res/place1" not in wp.g.lookup_counts, "was expecting the uri test to rule out person2 before its place was looked up"
+        for person in ("http://example.com/res/person2", "http://example.com/res/person3"):
+          assert person not in wp.g.lookup_counts, "was expecting the uri test to rule out %s before it was looked up" % person
+
+    for trace in (False, True):
+      wp = self.make_processor(self.foaf_data)
+      res = wp.select('http://example.com/res/person1', "foaf:knows/*[uri(.) = 'http://example.com/res/person3']", trace=trace)
+      assert res == [URIRef("http://example.com/res/person3")], "was expecting http://example.com/res/person3"
+      for person in ("http://example.com/res/person2", "http://example.com/res/person4"):
+        assert person not in wp.g.lookup_counts, "was not expecting %s to be looked up" % person
+
+  def test_or_stops_at_first_match(self):
+    wp = self.make_processor(self.foaf_data)
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*[foaf:based_near/*/foaf:name/text() = 'London' or foaf:nick]")
+    assert sorted(res) == [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")], "was expecting the friends with a nick"
+    assert "http://example.com/res/place1" not in wp.g.lookup_counts, "was expecting people with a nick not to have their place looked up"
+
+  def test_comparisons_of_each_kind(self):
+    wp = self.make_processor(self.foaf_data)
+    friends = [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3"), URIRef("http://example.com/res/person4")]
+    for (path, expected) in [
+        ("foaf:knows/*[foaf:age/text() > 32]", [URIRef("http://example.com/res/person3")]),
+        ("foaf:knows/*[32 = foaf:age/text()]", [URIRef("http://example.com/res/person2")]),
+        ("foaf:knows/*[foaf:nick = true()]", [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")]),
+        ("foaf:knows/*[true() = 'yes']", friends),
+        ("foaf:knows/*['Smith' = foaf:familyName/text()]", [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")]),
+        ("foaf:knows/*[foaf:nick/text() = foaf:givenName/text()]", [URIRef("http://example.com/res/person3")]),
+        ("foaf:knows/*[1 = 'one']", []),
+        ("foaf:knows/*[not(foaf:nick) != true()]", [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")]),
+        ("foaf:knows/*[true() != true()]", []),
+      ]:
+      assert sorted(wp.select('http://example.com/res/person1', path)) == expected, "was expecting %s for %s" % (expected, path)
+
+  def test_comparisons_of_non_ascii_literals(self):
+    wp = self.make_processor(u"""
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      @prefix res: <http://example.com/res/> .
+      res:person1 foaf:knows res:person2 .
+      res:person2 foaf:name "Zo\u00eb" ; foaf:age "25" .
+      """.encode("utf-8"))
+    assert wp.select('http://example.com/res/person1', "foaf:knows/*[foaf:name/text() > foaf:age/text()]") == [], "was expecting a name not to be greater than a number"
+    assert wp.select('http://example.com/res/person1', "foaf:knows/*[foaf:name/text() != foaf:age/text()]") == [URIRef("http://example.com/res/person2")], "was expecting the name and age to differ"
+
+  def test_numeric_comparisons_with_and_without_numpy(self):
+    paths = ["foaf:knows/*/foaf:knows/*[foaf:age/text() >= 32]", "foaf:knows/*/foaf:knows/*[count(foaf:knows/*) > 1]", "foaf:knows/*/foaf:knows/*[35 = foaf:age/text()]"]
+    expected = []
+    threshold = LinkPath.VECTOR_THRESHOLD
+    numpy = LinkPath.numpy
+    try:
+      LinkPath.numpy = None
+      wp = self.make_processor(self.foaf_data)
+      expected = [sorted(wp.select('http://example.com/res/person1', path)) for path in paths]
+      assert expected[0] == [URIRef("http://example.com/res/person2"), URIRef("http://example.com/res/person3")], "was expecting person2 and person3"
+
+      if numpy is not None:
+        LinkPath.numpy = numpy
+        LinkPath.VECTOR_THRESHOLD = 0
+        wp = self.make_processor(self.foaf_data)
+        assert [sorted(wp.select('http://example.com/res/person1', path)) for path in paths] == expected, "was expecting the same results using numpy"
+    finally:
+      LinkPath.VECTOR_THRESHOLD = threshold
+      LinkPath.numpy = numpy
+
+  def test_select_multi(self):
+    wp = self.make_processor(self.foaf_data)
+    paths = {
+      'names': "foaf:knows/*/foaf:givenName/text()",
+      'places': "foaf:knows/*/foaf:based_near/*",
+      'older': "foaf:knows/*[foaf:age/text() > 30]",
+      'friends': "foaf:knows/*",
+      'nicks': "foaf:nick/text()",
+    }
+    res = wp.select_multi('http://example.com/res/person1', paths)
+    assert sorted(res.keys()) == sorted(paths.keys()), "was expecting results for every path"
+    for (name, path) in paths.iteritems():
+      assert sorted(res[name]) == sorted(wp.select('http://example.com/res/person1', path)), "was expecting the same results as select for %s" % path
+
+  def test_inbound_axis(self):
+    wp = self.make_processor(self.foaf_data)
+    path = "in::foaf:knows/*"
+    expected = ['http://example.com/res/person1', 'http://example.com/res/person2', 'http://example.com/res/person4']
+    res = wp.select('http://example.com/res/person3', path)
+    assert sorted(str(r) for r in res) == expected, "was expecting the people who know person3"
+    res = wp.select('http://example.com/res/person3', path, trace=True)
+    assert sorted(str(r) for r in res) == expected, "was expecting the traced path to agree"
+    res = wp.iselect('http://example.com/res/person3', path)
+    assert sorted(str(r) for r in res) == expected, "was expecting iselect to agree"
+
+  def test_inbound_axis_in_filter(self):
+    wp = self.make_processor(self.foaf_data)
+    path = "foaf:knows/*[in::foaf:knows/*[foaf:age/text() < 22]]/foaf:givenName/text()"
+    for trace in (False, True):
+      res = wp.select('http://example.com/res/person1', path, trace=trace)
+      assert res == ['Jenny'], "was expecting only the friend known by someone under 22"
+
+  def test_inbound_counts_agree_with_trace(self):
+    wp = self.make_processor(self.foaf_data)
+    for op in ('=', '>'):
+      for number in ('1', '2'):
+        path = "foaf:knows/*[count(in::foaf:knows/*) %s %s]" % (op, number)
+        res = wp.select('http://example.com/res/person1', path)
+        traced = wp.select('http://example.com/res/person1', path, trace=True)
+        assert sorted(res) == sorted(traced), "was expecting the same results for %s" % path
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*[count(in::foaf:knows/*) = 2]")
+    assert sorted(res) == [URIRef('http://example.com/res/person2'), URIRef('http://example.com/res/person4')], "was expecting the friends known by two people"
+
+  def test_inbound_start_expands_each_subject_once(self):
+    data = ["@prefix foaf: <http://xmlns.com/foaf/0.1/> ."]
+    for i in range(20):
+      data.append("<http://example.com/res/person%s> foaf:knows <http://example.com/res/hub> ." % i)
+    wp = self.make_processor("\n".join(data))
+    expanded = []
+    get_objects_property_subjects = wp.g.get_objects_property_subjects
+    def record(pairs):
+      subjects = get_objects_property_subjects(pairs)
+      expanded.extend(s for values in subjects for s in values)
+      return subjects
+    wp.g.get_objects_property_subjects = record
+    for select in (lambda: wp.select('http://example.com/res/hub', "in::foaf:knows/*"),
+        lambda: wp.select('http://example.com/res/hub', "in::foaf:knows/*", trace=True),
+        lambda: dict(wp.select_many(['http://example.com/res/hub'], "in::foaf:knows/*"))['http://example.com/res/hub'],
+        lambda: wp.select_multi('http://example.com/res/hub', {'known_by': "in::foaf:knows/*"})['known_by']):
+      del expanded[:]
+      assert len(select()) == 20, "was expecting everyone who knows the hub"
+      assert len(expanded) == 20, "was expecting each subject to be expanded once, not %s times" % (len(expanded) / 20.0)
+
+  def test_select_multi_with_both_axes(self):
+    wp = self.make_processor(self.foaf_data)
+    res = wp.select_multi('http://example.com/res/person4', {'knows': "foaf:knows/*", 'known_by': "in::foaf:knows/*"})
+    assert [str(r) for r in res['knows']] == ['http://example.com/res/person3'], "was expecting the people person4 knows"
+    assert sorted(str(r) for r in res['known_by']) == ['http://example.com/res/person1', 'http://example.com/res/person3'], "was expecting the people who know person4"
+
+  def test_repeated_steps(self):
+    wp = self.make_processor(self.foaf_data)
+    people = ['http://example.com/res/person%s' % i for i in range(5)]
+    expected = {
+      "foaf:knows{1}/*": [people[3]],
+      "foaf:knows{2}/*": [people[1], people[2], people[4]],
+      "foaf:knows{1,2}/*": people[1:],
+      "foaf:knows+/*": people[1:],
+      "foaf:knows+/*/foaf:givenName/text()": ['Andrew', 'Emily', 'Jenny', 'Wilbur'],
+      "in::foaf:knows{2,}/*": people[1:],
+    }
+    for (path, values) in expected.iteritems():
+      assert str(wp.parse_path(path)) == path, "was expecting %s to be written the same way" % path
+      for trace in (False, True):
+        res = wp.select('http://example.com/res/person4', path, trace=trace)
+        assert sorted(str(r) for r in res) == values, "was expecting %s for %s" % (values, path)
+      assert sorted(str(r) for r in wp.iselect('http://example.com/res/person4', path)) == values, "was expecting iselect to agree for %s" % path
+
+    # A is first reached after one repeat, and again after two on the way to C
+    wp = self.make_processor("""
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      <urn:S> foaf:knows <urn:A>, <urn:B> .
+      <urn:B> foaf:knows <urn:A> .
+      <urn:A> foaf:knows <urn:C> .
+      """)
+    for (path, values) in [("foaf:knows{3}/*", ['urn:C']), ("foaf:knows{2,3}/*", ['urn:A', 'urn:C'])]:
+      for trace in (False, True):
+        res = wp.select('urn:S', path, trace=trace)
+        assert sorted(str(r) for r in res) == values, "was expecting %s for %s" % (values, path)
+        assert res.complete, "was expecting a complete result for %s" % path
+
+  def test_repeat_must_be_at_least_once(self):
+    wp = self.make_processor(self.foaf_data)
+    self.assertRaises(LinkPath.ParseError, wp.parse_path, "foaf:knows{0,2}/*")
+    self.assertRaises(LinkPath.ParseError, wp.parse_path, "foaf:knows{3,2}/*")
+
+  def make_hub_processor(self, people):
+    # person1 knows a hub that knows many people, each with an age
+    data = [
+      "@prefix foaf: <http://xmlns.com/foaf/0.1/> .",
+      "<http://example.com/res/person1> foaf:knows <http://example.com/res/hub> .",
+    ]
+    for i in range(people):
+      data.append('<http://example.com/res/hub> foaf:knows <http://example.com/res/friend%s> .' % i)
+      data.append('<http://example.com/res/friend%s> foaf:age "%s" .' % (i, 20 + i))
+    return self.make_processor("\n".join(data))
+
+  def friends_looked_up(self, wp):
+    return len([uri for uri in wp.g.lookup_counts if 'friend' in uri])
+
+  def test_existence_stops_at_first_match(self):
+    hub = URIRef("http://example.com/res/hub")
+    for path in ("foaf:knows/*[foaf:knows/*[foaf:age]]", "foaf:knows/*[boolean(foaf:knows/*[foaf:age])]"):
+      wp = self.make_hub_processor(50)
+      res = wp.select('http://example.com/res/person1', path)
+      assert res == [hub], "was expecting the hub for %s" % path
+      assert self.friends_looked_up(wp) == 1, "was expecting only the first friend to be looked up for %s" % path
+    wp = self.make_hub_processor(50)
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*[not(foaf:knows/*[foaf:age])]")
+    assert res == [], "was expecting no results"
+    assert self.friends_looked_up(wp) == 1, "was expecting only the first friend to be looked up"
+
+  def test_count_stops_once_comparison_is_decided(self):
+    hub = URIRef("http://example.com/res/hub")
+    wp = self.make_hub_processor(50)
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*[count(foaf:knows/*[foaf:age]) > 2]")
+    assert res == [hub], "was expecting the hub"
+    assert self.friends_looked_up(wp) == 3, "was expecting the friends to be counted until there were more than 2"
+    wp = self.make_hub_processor(50)
+    res = wp.select('http://example.com/res/person1', "foaf:knows/*[1 > count(foaf:knows/*[foaf:age/text() > 100])]")
+    assert res == [hub], "was expecting the hub"
+    assert self.friends_looked_up(wp) == 50, "was expecting every friend to be counted"
+
+  def test_limited_and_full_counts_agree(self):
+    wp = self.make_processor(self.foaf_data)
+    for op in ('=', '!=', '<', '<=', '>', '>='):
+      for number in ('0', '1', '2', '2.5', '3'):
+        for path in ("foaf:knows/*[count(foaf:knows/*) %s %s]" % (op, number), "foaf:knows/*[%s %s count(foaf:knows/*[foaf:age/text() > 30])]" % (number, op)):
+          res = wp.select('http://example.com/res/person1', path)
+          traced = wp.select('http://example.com/res/person1', path, trace=True)
+          assert sorted(res) == sorted(traced), "was expecting the same results for %s" % path
+
+  def test_select_multi_shares_common_steps(self):
+    g = FakeAggregatingGraph()
+    d = Graph()
+    d.parse(StringInputSource(self.foaf_data), format="n3")
+    g.set_all(d)
+    expanded = []
+    get_subjects_property_values = g.get_subjects_property_values
+    def record(pairs):
+      expanded.append(set(pairs))
+      return get_subjects_property_values(pairs)
+    g.get_subjects_property_values = record
+
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    wp.select_multi('http://example.com/res/person1', {'names': "foaf:knows/*/foaf:givenName/text()", 'places': "foaf:knows/*/foaf:based_near/*"})
+    knows = (URIRef('http://example.com/res/person1'), URIRef('http://xmlns.com/foaf/0.1/knows'))
+    assert len([pairs for pairs in expanded if knows in pairs]) == 1, "was expecting the foaf:knows arc to be followed once for both paths"
+
+  def test_frontier_and_candidate_evaluation_agree(self):
+    wp = self.make_processor(self.foaf_data)
+    paths = [
+      "foaf:knows/*/foaf:knows/foaf:Person[foaf:familyName/text() = 'Smith']/foaf:givenName/text()",
+      "foaf:knows/*/foaf:knows/*[count(foaf:knows) > 1 or foaf:nick]",
+      "*/*[foaf:based_near/*/foaf:name/text() = 'London'][not(ex:Colleague)]",
+    ]
+    for path in paths:
+      start = Node(URIRef('http://example.com/res/person1'), wp.g).get_arcs()
+      each = wp.parse_path(path).select(start, wp.g, None)
+      assert sorted(set(r.value for r in each)) == sorted(wp.select('http://example.com/res/person1', path)), "was expecting the same results for %s" % path
+
   def test_number_function(self):
     wp = self.make_processor(self.foaf_data)
 
@@ -439,12 +813,669 @@ class TestLinkPathProcessor(unittest.TestCase):
     assert URIRef("http://example.com/res/person3") in res, "was expecting http://example.com/res/person3 in result list"
 
 
+class TestAggregatingGraph(unittest.TestCase):
+  doc_data = """
+    @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+    <http://example.com/res/person%s> foaf:knows <http://example.com/res/person%s> .
+    """
+
+  def make_graph(self, count):
+    return make_chain_graph(count)
+
+  def test_lookup_many_fetches_each_document_once(self):
+    g = self.make_graph(3)
+    uris = ["http://example.com/res/person1", "http://example.com/res/person2", "http://example.com/res/person3"]
+    g.lookup_many(uris)
+    g.lookup_many(uris)
+    assert sorted(g.fetches) == uris, "was expecting one fetch per uri"
+    assert len(g.g) == 3, "was expecting 3 triples"
+
+  def test_lookup_many_ignores_missing_documents(self):
+    g = self.make_graph(1)
+    g.lookup_many(["http://example.com/res/person1", "http://example.com/res/missing"])
+    assert len(g.g) == 1, "was expecting 1 triple"
+
+  def test_fragments_share_one_fetch(self):
+    g = self.make_graph(1)
+    g.lookup_many(["http://example.com/res/person1#a", "http://example.com/res/person1#b"])
+    g.lookup("http://example.com/res/person1#c")
+    assert g.fetches == ["http://example.com/res/person1"], "was expecting one fetch of the document"
+    assert len(g.g) == 1, "was expecting 1 triple"
+
+  def test_concurrent_lookups_share_one_fetch(self):
+    g = self.make_graph(1)
+    g.delay = 0.05
+    threads = [threading.Thread(target=g.lookup, args=("http://example.com/res/person1#%s" % i,)) for i in range(5)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    assert g.fetches == ["http://example.com/res/person1"], "was expecting one fetch of the document"
+
+  def test_select_many(self):
+    g = self.make_graph(6)
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    uris = ["http://example.com/res/person%s" % i for i in range(1, 6)]
+    res = list(wp.select_many(uris, "foaf:knows/*/foaf:knows/*", batch_size=2))
+    assert [uri for (uri, results) in res] == uris, "was expecting results for each uri in order"
+    for (uri, results) in res:
+      assert results == wp.select(uri, "foaf:knows/*/foaf:knows/*"), "was expecting the same results as select for %s" % uri
+    assert sorted(set(g.fetches)) == sorted(g.fetches), "was expecting each document to be fetched once"
+    assert wp.plans.misses == 1, "was expecting the path to be compiled once"
+
+  def test_select_many_with_workers(self):
+    g = self.make_graph(10)
+    g.delay = 0.01
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    uris = ["http://example.com/res/person%s" % i for i in range(1, 10)]
+    res = list(wp.select_many(uris, "foaf:knows/*", workers=4, batch_size=1))
+    assert res == [(uri, [URIRef("http://example.com/res/person%s" % (i + 1))]) for (i, uri) in zip(range(1, 10), uris)], "was expecting each person's friend in order"
+
+  def test_type_index_updated_on_ingest(self):
+    g = FakeFetchingGraph()
+    g.set("http://example.com/res/person1", """
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      <http://example.com/res/person1> a foaf:Person, foaf:Agent ; foaf:knows <http://example.com/res/person2> .
+      """)
+    g.set("http://example.com/res/person2", """
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      <http://example.com/res/person2> a foaf:Person .
+      """)
+    person1 = URIRef("http://example.com/res/person1")
+    person2 = URIRef("http://example.com/res/person2")
+    assert g.get_types(person1) == set([URIRef("http://xmlns.com/foaf/0.1/Person"), URIRef("http://xmlns.com/foaf/0.1/Agent")]), "was expecting person1's types"
+    assert g.types[URIRef("http://xmlns.com/foaf/0.1/Person")] == set([person1]), "was expecting person2 not to be indexed before it is looked up"
+    typed = g.get_typed_subjects([person1, person2, URIRef("http://example.com/res/missing")], URIRef("http://xmlns.com/foaf/0.1/Person"))
+    assert typed == set([person1, person2]), "was expecting both people"
+
+  def test_inbound_index_updated_on_ingest(self):
+    g = FakeFetchingGraph()
+    g.set("http://example.com/res/person1", """
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      <http://example.com/res/person1> foaf:name "Person 1" ; foaf:knows <http://example.com/res/person2> .
+      """)
+    g.set("http://example.com/res/person2", """
+      @prefix foaf: <http://xmlns.com/foaf/0.1/> .
+      <http://example.com/res/person2> foaf:knows <http://example.com/res/person1> .
+      """)
+    person1 = URIRef("http://example.com/res/person1")
+    person2 = URIRef("http://example.com/res/person2")
+    knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+    assert g.get_object_properties(person2, True) == [], "was expecting no arcs to person2 until person1 is looked up"
+    g.lookup(person1)
+    assert g.get_object_properties(person2, True) == [knows], "was expecting the arc from person1"
+    assert g.get_objects_property_subjects([(person2, knows), (person1, knows)]) == [[person1], [person2]], "was expecting the subjects of each arc"
+    assert g.store.inbound_predicates(Literal("Person 1")) == [], "was expecting literals not to be indexed"
+
+  def test_literal_values_converted_once(self):
+    g = AggregatingGraph()
+    value = g.literal_value(Literal("32"))
+    assert value == ("32", 32.0), "was expecting the string and number of the literal"
+    assert g.literal_value(Literal("32")) is value, "was expecting the cached value"
+    assert g.literal_value(Literal("Smith")) == ("Smith", None), "was expecting no number for a string"
+
+  def test_type_index_follows_changes_to_graph(self):
+    person = URIRef("http://xmlns.com/foaf/0.1/Person")
+    person1 = URIRef("http://example.com/res/person1")
+    person2 = URIRef("http://example.com/res/person2")
+    for store in (None, CompactStore()):
+      g = AggregatingGraph(store=store)
+      d = Graph()
+      d.add((person1, RDF.type, person))
+      g.g += d
+      g.g.parse(data="<http://example.com/res/person2> <%s> <%s> .\n" % (RDF.type, person), format="nt")
+      assert g.types[person] == set([person1, person2]), "was expecting triples added to the graph to be indexed"
+      assert g.subject_types[person2] == set([person]), "was expecting person2's type"
+      g.g.remove((person1, None, None))
+      assert g.types[person] == set([person2]), "was expecting removed triples to leave the index"
+      assert g.subject_types[person1] == set(), "was expecting person1 to have no types"
+
+  def test_select_prefetches_frontier(self):
+    g = self.make_graph(4)
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*")
+    assert res == [URIRef("http://example.com/res/person3")], "was expecting http://example.com/res/person3"
+    assert "http://example.com/res/person3" not in g.fetches, "was not expecting the final step to be looked up"
+
+
+class TestCompactStore(unittest.TestCase):
+
+  def test_add_and_query(self):
+    store = CompactStore()
+    person1 = URIRef("http://example.com/res/person1")
+    person2 = URIRef("http://example.com/res/person2")
+    knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+    name = URIRef("http://xmlns.com/foaf/0.1/name")
+    graph = Graph(store=store)
+    for triple in [(person1, knows, person2), (person1, name, Literal("Person 1")), (person2, knows, person1), (person1, knows, person2)]:
+      graph.add(triple)
+    assert len(store) == 3, "was expecting the duplicate triple to be added once"
+    assert (person1, knows, person2) in store, "was expecting the triple to be in the store"
+    assert (person2, knows, person2) not in store, "was not expecting a triple that wasn't added"
+    assert (person1, knows, URIRef("http://example.com/res/missing")) not in store, "was not expecting a triple with an unknown term"
+    assert sorted(store.predicates(person1)) == [knows, name], "was expecting person1's properties"
+    assert store.objects(person1, knows) == [person2], "was expecting the people person1 knows"
+    assert store.objects(person1, name) == [Literal("Person 1")], "was expecting person1's name"
+    assert store.subjects(knows, person2) == [person1], "was expecting the people who know person2"
+    assert store.inbound_predicates(person1) == [knows], "was expecting the arcs to person1"
+    assert store.inbound_predicates(Literal("Person 1")) == [], "was expecting literals not to be indexed"
+
+  def test_duplicates_found_for_large_subjects(self):
+    store = CompactStore()
+    hub = URIRef("http://example.com/res/hub")
+    knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+    triples = [(hub, knows, URIRef("http://example.com/res/person%s" % i)) for i in range(100)]
+    graph = Graph(store=store)
+    store.addN((s, p, o, graph) for (s, p, o) in triples)
+    store.addN((s, p, o, graph) for (s, p, o) in triples)
+    assert len(store) == 100, "was expecting each triple to be added once"
+    assert len(store.objects(hub, knows)) == 100, "was expecting everyone the hub knows"
+
+  def test_graph_over_store(self):
+    d = Graph()
+    d.parse(StringInputSource(TestLinkPathProcessor.foaf_data), format="n3")
+    g = AggregatingGraph(store=CompactStore())
+    g.g.parse(data=d.serialize(format="nt"), format="nt")
+    assert len(g.g) == len(d), "was expecting every parsed triple"
+    assert sorted(g.g) == sorted(d), "was expecting the graph to give back the same triples"
+    person1 = URIRef("http://example.com/res/person1")
+    knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+    assert sorted(g.g.subjects(knows, person1)) == sorted(d.subjects(knows, person1)), "was expecting the people who know person1"
+    assert sorted(g.g.triples((None, knows, None))) == sorted(d.triples((None, knows, None))), "was expecting every foaf:knows triple"
+    g.g.remove((None, knows, person1))
+    assert g.store.subjects(knows, person1) == [], "was expecting the arcs to person1 to be removed"
+    assert g.store.inbound_predicates(person1) == [], "was expecting the inbound index to be updated"
+    assert len(g.g) == len(d) - len(list(d.subjects(knows, person1))), "was expecting the removed triples not to be counted"
+
+  def test_queries_agree_with_default_store(self):
+    paths = [
+      "foaf:knows/*/foaf:givenName/text()",
+      "foaf:knows/foaf:Person[foaf:age/text() > 30]",
+      "foaf:knows/*[count(foaf:knows/*) > 2]/foaf:nick/text()",
+      "foaf:knows/*[not(foaf:based_near)]",
+      "foaf:knows+/*",
+      "foaf:knows/*/in::foaf:knows/*",
+      "*[namespace-uri(.) = 'http://xmlns.com/foaf/0.1/']",
+    ]
+    processors = []
+    for store in (None, CompactStore()):
+      g = FakeAggregatingGraph(store)
+      d = Graph()
+      d.parse(StringInputSource(TestLinkPathProcessor.foaf_data), format="n3")
+      g.set_all(d)
+      wp = LinkPathProcessor(g)
+      wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+      processors.append(wp)
+    assert len(processors[0].g.g) == len(processors[1].g.g), "was expecting the same number of triples"
+    for path in paths:
+      (expected, res) = [sorted(wp.select('http://example.com/res/person1', path)) for wp in processors]
+      assert len(expected) > 0, "was expecting results for %s" % path
+      assert res == expected, "was expecting the same results for %s" % path
+
+
+class TestQueryLimits(unittest.TestCase):
+
+  def make_processor(self, count):
+    g = make_chain_graph(count)
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    return wp
+
+  def test_unlimited_query_is_complete(self):
+    wp = self.make_processor(5)
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+    assert res == [URIRef("http://example.com/res/person4")], "was expecting http://example.com/res/person4"
+    assert res.complete, "was expecting a complete result"
+
+  def test_repeated_step_fetches_each_document_once(self):
+    wp = self.make_processor(10)
+    res = wp.select("http://example.com/res/person1", "foaf:knows+/*")
+    assert sorted(res) == sorted(URIRef("http://example.com/res/person%s" % i) for i in range(2, 12)), "was expecting everyone along the chain"
+    assert res.complete, "was expecting a complete result"
+    assert sorted(wp.g.fetches) == sorted(set(wp.g.fetches)), "was expecting each document to be fetched once"
+    res = wp.select("http://example.com/res/person1", "foaf:knows{1,3}/*")
+    assert sorted(res) == [URIRef("http://example.com/res/person%s" % i) for i in range(2, 5)], "was expecting the first three people along the chain"
+
+  def test_repeated_step_stops_at_depth_cap(self):
+    wp = self.make_processor(10)
+    depth = LinkPath.MAX_CLOSURE_DEPTH
+    LinkPath.MAX_CLOSURE_DEPTH = 3
+    try:
+      res = wp.select("http://example.com/res/person1", "foaf:knows+/*", max_documents=100)
+    finally:
+      LinkPath.MAX_CLOSURE_DEPTH = depth
+    assert sorted(res) == [URIRef("http://example.com/res/person%s" % i) for i in range(2, 5)], "was expecting the first three people along the chain"
+    assert not res.complete, "was expecting an incomplete result"
+    assert len(wp.g.fetches) == 3, "was expecting 3 fetches"
+
+  def test_repeated_step_cut_short_without_limits_is_incomplete(self):
+    g = AggregatingGraph()
+    knows = URIRef("http://xmlns.com/foaf/0.1/knows")
+    g.add_triples((URIRef("urn:p%s" % i), knows, URIRef("urn:p%s" % ((i + 1) % 100))) for i in range(100))
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    res = wp.select("urn:p0", "foaf:knows+/*")
+    assert len(res) == LinkPath.MAX_CLOSURE_DEPTH, "was expecting the closure to stop at the depth cap"
+    assert not res.complete, "was expecting an incomplete result"
+    for (uri, res) in wp.select_many(["urn:p0", "urn:p50"], "foaf:knows+/*"):
+      assert not res.complete, "was expecting an incomplete result for %s" % uri
+    res = wp.select("urn:p0", "foaf:knows{1,3}/*")
+    assert len(res) == 3 and res.complete, "was expecting a complete result within the cap"
+
+  def test_max_documents(self):
+    wp = self.make_processor(5)
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*", max_documents=2)
+    assert res == [], "was expecting no results"
+    assert not res.complete, "was expecting an incomplete result"
+    assert len(wp.g.fetches) == 2, "was expecting 2 fetches"
+
+  def test_max_bytes(self):
+    wp = self.make_processor(5)
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*", max_bytes=1)
+    assert not res.complete, "was expecting an incomplete result"
+    assert len(wp.g.fetches) == 1, "was expecting 1 fetch"
+
+  def test_timeout(self):
+    wp = self.make_processor(5)
+    wp.g.delay = 0.05
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*", timeout=0.01)
+    assert res == [], "was expecting no results"
+    assert not res.complete, "was expecting an incomplete result"
+    assert wp.g.timeouts == [0.01], "was expecting the timeout to be passed to fetch"
+
+  def test_deadline_applies_to_documents_fetched_by_another_query(self):
+    wp = self.make_processor(5)
+    wp.g.delay = 1
+    other = threading.Thread(target=wp.g.lookup, args=("http://example.com/res/person1",))
+    other.start()
+    time.sleep(0.1)
+    start = time.time()
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*", deadline=0.2)
+    elapsed = time.time() - start
+    other.join()
+    assert elapsed < 0.6, "was expecting the query to stop waiting at its deadline"
+    assert not res.complete, "was expecting an incomplete result"
+
+  def test_deadline(self):
+    wp = self.make_processor(5)
+    wp.g.delay = 0.05
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*", deadline=0.08)
+    assert not res.complete, "was expecting an incomplete result"
+    assert len(wp.g.fetches) == 2, "was expecting the deadline to stop fetching"
+
+  def test_later_query_fetches_skipped_documents(self):
+    wp = self.make_processor(5)
+    wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*", max_documents=1)
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+    assert res == [URIRef("http://example.com/res/person4")], "was expecting http://example.com/res/person4"
+
+  def test_later_query_fetches_documents_that_timed_out(self):
+    wp = self.make_processor(5)
+    wp.g.delay = 0.05
+    wp.select("http://example.com/res/person1", "foaf:knows/*", timeout=0.01)
+    wp.g.delay = 0
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*")
+    assert res == [URIRef("http://example.com/res/person2")], "was expecting http://example.com/res/person2"
+    assert res.complete, "was expecting a complete result"
+    assert len(wp.g.fetches) == 2, "was expecting the document to be fetched again"
+
+
+class TestNegativeCache(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_failed_documents_are_not_refetched(self):
+    failures = NegativeCache()
+    make_chain_graph(1, negative_cache=failures).lookup("http://example.com/res/missing")
+    g = make_chain_graph(1, negative_cache=failures)
+    g.lookup("http://example.com/res/missing")
+    assert g.fetches == [], "was not expecting a fetch"
+    assert failures.uris["http://example.com/res/missing"]['failure'] == 'status', "was expecting a status failure"
+    assert failures.uris["http://example.com/res/missing"]['status'] == 404, "was expecting a 404 status"
+
+  def test_failures_back_off_exponentially(self):
+    failures = NegativeCache(base_delay=10)
+    failures.failed("http://example.com/res/missing", 'syntax')
+    failures.failed("http://example.com/res/missing", 'syntax')
+    failures.failed("http://example.com/res/missing", 'syntax')
+    entry = failures.uris["http://example.com/res/missing"]
+    assert entry['failures'] == 3, "was expecting 3 failures"
+    assert 39 < entry['retry'] - time.time() <= 40, "was expecting a 40 second backoff"
+
+  def test_documents_are_retried_after_backoff(self):
+    failures = NegativeCache(base_delay=0)
+    make_chain_graph(1, negative_cache=failures).lookup("http://example.com/res/missing")
+    g = make_chain_graph(1, negative_cache=failures)
+    g.lookup("http://example.com/res/missing")
+    assert g.fetches == ["http://example.com/res/missing"], "was expecting a fetch"
+
+  def test_success_clears_failures(self):
+    failures = NegativeCache(base_delay=0)
+    failures.failed("http://example.com/res/person1", 'network')
+    make_chain_graph(1, negative_cache=failures).lookup("http://example.com/res/person1")
+    assert failures.uris == {} and failures.hosts == {}, "was expecting failures to be cleared"
+
+  def test_unreachable_hosts_are_skipped(self):
+    failures = NegativeCache()
+    g = make_chain_graph(1, negative_cache=failures)
+    g.unreachable = True
+    self.assertRaises(socket.error, g.lookup, "http://example.com/res/person1")
+
+    g = make_chain_graph(2, negative_cache=failures)
+    g.lookup("http://example.com/res/person2")
+    assert g.fetches == [], "was not expecting a fetch from an unreachable host"
+    assert failures.hosts["example.com"]['failure'] == 'network', "was expecting a network failure"
+
+  def test_query_timeouts_are_not_remembered(self):
+    failures = NegativeCache()
+    g = make_chain_graph(1, negative_cache=failures)
+    g.delay = 0.05
+    res = LinkPathProcessor(g).select("http://example.com/res/person1", "*", timeout=0.01)
+    assert not res.complete, "was expecting an incomplete result"
+    assert failures.uris == {} and failures.hosts == {}, "was not expecting the timeout to be remembered"
+    g = make_chain_graph(1, negative_cache=failures)
+    g.lookup("http://example.com/res/person1")
+    assert g.fetches == ["http://example.com/res/person1"], "was expecting the document to be fetched again"
+
+  def test_failures_are_persisted(self):
+    path = os.path.join(self.path, "failures.json")
+    make_chain_graph(1, negative_cache=NegativeCache(path)).lookup("http://example.com/res/missing")
+    g = make_chain_graph(1, negative_cache=NegativeCache(path))
+    g.lookup("http://example.com/res/missing")
+    assert g.fetches == [], "was not expecting a fetch"
+
+
+class TestFetchArchive(unittest.TestCase):
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.archive_path = os.path.join(self.path, "crawl.gz")
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def record(self):
+    archive = FetchArchive(self.archive_path)
+    wp = LinkPathProcessor(make_chain_graph(4, archive=archive))
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    res = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+    archive.close()
+    return res
+
+  def replay(self, latency=None):
+    g = AggregatingGraph(archive=FetchArchive(self.archive_path, 'replay', latency))
+    g.scheduler = None
+    wp = LinkPathProcessor(g)
+    wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+    return wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+
+  def test_replay_matches_recording(self):
+    recorded = self.record()
+    assert recorded == [URIRef("http://example.com/res/person4")], "was expecting http://example.com/res/person4"
+    assert self.replay() == recorded, "was expecting the replay to select the same results"
+
+  def test_replay_latency(self):
+    self.record()
+    start = time.time()
+    self.replay({'example.com' : 0.02})
+    assert time.time() - start >= 0.06, "was expecting each of 3 lookups to take 0.02 seconds"
+
+  def test_recording_with_a_cache_keeps_cached_documents(self):
+    for ttl in (3600, 0):
+      cache = DocumentCache(os.path.join(self.path, "cache%s" % ttl), ttl=ttl)
+      wp = LinkPathProcessor(make_chain_graph(4, cache=cache))
+      wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+      wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+
+      if os.path.exists(self.archive_path):
+        os.remove(self.archive_path)
+      archive = FetchArchive(self.archive_path)
+      g = make_chain_graph(4, cache=cache, archive=archive)
+      wp = LinkPathProcessor(g)
+      wp.bind("foaf", "http://xmlns.com/foaf/0.1/")
+      recorded = wp.select("http://example.com/res/person1", "foaf:knows/*/foaf:knows/*/foaf:knows/*")
+      archive.close()
+      assert recorded == [URIRef("http://example.com/res/person4")], "was expecting http://example.com/res/person4"
+      if ttl == 0:
+        assert g.not_modified > 0, "was expecting the cached documents to be revalidated"
+      assert self.replay() == recorded, "was expecting the replay to select the same results with a ttl of %s" % ttl
+
+  def test_unrecorded_uris_are_not_found(self):
+    self.record()
+    status = FetchArchive(self.archive_path, 'replay').replay("http://example.com/res/other")[0].status
+    assert status == 404, "was expecting a 404 response"
+
+
+class TestStreamingIngestion(unittest.TestCase):
+  nt_data = """<http://example.com/res/person1> <http://xmlns.com/foaf/0.1/knows> <http://example.com/res/person2> .
+# a comment
+<http://example.com/res/person1> <http://xmlns.com/foaf/0.1/name> "Wilbur"@en .
+"""
+  nq_data = """<http://example.com/res/person1> <http://xmlns.com/foaf/0.1/knows> <http://example.com/res/person2> <http://example.com/graph> .
+<http://example.com/res/person1> <http://xmlns.com/foaf/0.1/name> "Wilbur" .
+"""
+  rdfxml_data = """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:foaf="http://xmlns.com/foaf/0.1/">
+  <foaf:Person rdf:about="#me">
+    <foaf:knows rdf:resource="http://example.com/res/person2"/>
+    <foaf:name>Wilbur</foaf:name>
+  </foaf:Person>
+</rdf:RDF>
+"""
+
+  def make_graph(self, content_type, data):
+    g = FakeFetchingGraph(stream=True, chunk_size=16)
+    g.set("http://example.com/res/person1", data, content_type)
+    return g
+
+  def test_ntriples(self):
+    g = self.make_graph('application/n-triples', self.nt_data)
+    g.lookup("http://example.com/res/person1")
+    assert len(g.g) == 2, "was expecting 2 triples"
+    assert g.largest_read <= 2048, "was expecting the document to be read in chunks"
+
+  def test_streamed_types_are_indexed(self):
+    g = self.make_graph('application/rdf+xml', self.rdfxml_data)
+    g.lookup("http://example.com/res/person1")
+    assert g.get_types(URIRef("http://example.com/res/person1#me")) == set([URIRef("http://xmlns.com/foaf/0.1/Person")]), "was expecting the streamed type to be indexed"
+
+  def test_nquads(self):
+    g = self.make_graph('application/n-quads', self.nq_data)
+    g.lookup("http://example.com/res/person1")
+    assert len(g.g) == 2, "was expecting 2 triples"
+
+  def test_rdfxml(self):
+    g = self.make_graph('application/rdf+xml', self.rdfxml_data)
+    g.lookup("http://example.com/res/person1")
+    assert len(g.g) == 3, "was expecting 3 triples"
+    assert g.largest_read == 16, "was expecting the document to be read in chunks"
+    assert (URIRef("http://example.com/res/person1#me"), RDF.type, URIRef("http://xmlns.com/foaf/0.1/Person")) in g.g, "was expecting the document uri to be the base"
+
+  def test_turtle_is_read_whole(self):
+    g = self.make_graph('text/turtle', TestAggregatingGraph.doc_data % (1, 2))
+    g.lookup("http://example.com/res/person1")
+    assert len(g.g) == 1, "was expecting 1 triple"
+
+
+class TestDocumentCache(unittest.TestCase):
+  doc_data = TestAggregatingGraph.doc_data
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def make_graph(self, cache):
+    g = FakeFetchingGraph(cache=cache)
+    g.set("http://example.com/res/person1", self.doc_data % (1, 2))
+    return g
+
+  def test_fresh_documents_are_not_refetched(self):
+    self.make_graph(DocumentCache(self.path)).lookup("http://example.com/res/person1")
+
+    g = self.make_graph(DocumentCache(self.path))
+    g.lookup("http://example.com/res/person1")
+    assert g.fetches == [], "was not expecting a fetch"
+    assert len(g.g) == 1, "was expecting 1 triple"
+
+  def test_stale_documents_are_revalidated(self):
+    self.make_graph(DocumentCache(self.path, ttl=0)).lookup("http://example.com/res/person1")
+
+    g = self.make_graph(DocumentCache(self.path, ttl=0))
+    g.lookup("http://example.com/res/person1")
+    assert g.fetches == ["http://example.com/res/person1"], "was expecting a conditional fetch"
+    assert g.not_modified == 1, "was expecting a 304 response"
+    assert len(g.g) == 1, "was expecting 1 triple"
+
+  def test_cached_documents_are_loaded_from_snapshots(self):
+    self.make_graph(DocumentCache(self.path)).lookup("http://example.com/res/person1")
+    assert os.path.exists(DocumentCache(self.path).filename("http://example.com/res/person1", 'triples')), "was expecting a triple snapshot"
+
+    g = self.make_graph(DocumentCache(self.path))
+    f = open(g.cache.filename("http://example.com/res/person1", 'body'), 'wb')
+    f.write('not turtle')
+    f.close()
+    g.lookup("http://example.com/res/person1")
+    assert len(g.g) == 1, "was expecting 1 triple from the snapshot"
+
+  def test_unreadable_snapshots_are_replaced(self):
+    self.make_graph(DocumentCache(self.path)).lookup("http://example.com/res/person1")
+    for data in (marshal.dumps((0, [], '')), 'not a snapshot'):
+      cache = DocumentCache(self.path)
+      filename = cache.filename("http://example.com/res/person1", 'triples')
+      f = open(filename, 'wb')
+      f.write(data)
+      f.close()
+      g = self.make_graph(cache)
+      g.lookup("http://example.com/res/person1")
+      assert len(g.g) == 1, "was expecting 1 triple parsed from the cached document"
+      assert len(load_triples(open(filename, 'rb').read())) == 1, "was expecting the snapshot to be replaced"
+
+  def test_snapshot_round_trip(self):
+    d = Graph()
+    d.add((URIRef("http://example.com/s"), EX.p, Literal("chat", lang="fr")))
+    d.add((URIRef("http://example.com/s"), EX.p, Literal("12", datatype=EX.dt)))
+    d.add((BNode(), EX.p, URIRef("http://example.com/s")))
+    triples = load_triples(dump_triples(d))
+    assert len(triples) == 3, "was expecting 3 triples"
+    for t in triples:
+      assert t in d, "was expecting %s to round trip" % (t,)
+
+  def test_least_recently_used_documents_are_evicted(self):
+    cache = DocumentCache(self.path)
+    g = FakeFetchingGraph(cache=cache)
+    g.set("http://example.com/res/person1", self.doc_data % (1, 2))
+    g.set("http://example.com/res/person2", self.doc_data % (2, 3))
+    g.lookup("http://example.com/res/person1")
+    cache.max_size = cache.size + 20
+    os.utime(cache.filename("http://example.com/res/person1", 'json'), (0, 0))
+    g.lookup("http://example.com/res/person2")
+    assert cache.get("http://example.com/res/person1") is None, "was expecting person1 to be evicted"
+    assert cache.get("http://example.com/res/person2") is not None, "was expecting person2 to be cached"
+
+  def test_size_after_eviction_counts_remaining_files(self):
+    cache = DocumentCache(self.path)
+    g = FakeFetchingGraph(cache=cache)
+    g.set("http://example.com/res/person1", self.doc_data % (1, 2))
+    g.set("http://example.com/res/person2", self.doc_data % (2, 3))
+    g.lookup("http://example.com/res/person1")
+    assert os.path.exists(cache.filename("http://example.com/res/person1", 'triples')), "was expecting a triple snapshot"
+    cache.max_size = cache.size + 20
+    os.utime(cache.filename("http://example.com/res/person1", 'json'), (0, 0))
+    g.lookup("http://example.com/res/person2")
+    assert cache.get("http://example.com/res/person1") is None, "was expecting person1 to be evicted"
+    on_disk = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path) if name.endswith(('.body', '.triples')))
+    assert cache.size == on_disk, "was expecting the size to count only the documents left"
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+  def request_all(self, scheduler, uris):
+    threads = [threading.Thread(target=scheduler.request, args=(uri, {})) for uri in uris]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+  def test_limits_connections_per_host(self):
+    scheduler = FakeScheduler(max_per_host=2)
+    self.request_all(scheduler, ["http://example.com/%s" % i for i in range(10)])
+    assert scheduler.most_active == 2, "was expecting at most 2 concurrent requests"
+    assert scheduler.stats()['clients_created'] == 2, "was expecting 2 clients"
+    assert scheduler.stats()['connections_reused'] == 8, "was expecting 8 reused connections"
+
+  def test_limits_requests_in_flight(self):
+    scheduler = FakeScheduler(max_per_host=4, max_in_flight=3)
+    self.request_all(scheduler, ["http://host%s.example.com/" % i for i in range(10)])
+    assert scheduler.most_active == 3, "was expecting at most 3 concurrent requests"
+    assert scheduler.stats()['connection_reuse_rate'] == 0.0, "was not expecting connections to be reused"
+
+  def test_limits_requests_per_second(self):
+    scheduler = FakeScheduler(requests_per_second=50)
+    start = time.time()
+    for i in range(5):
+      scheduler.request("http://example.com/%s" % i, {})
+    assert time.time() - start >= 0.08, "was expecting requests to be spaced out"
+    assert scheduler.stats()['client_reuse_rate'] == 0.8, "was expecting 4 of 5 requests to reuse a client"
+
+
+class FakeScheduler(FetchScheduler):
+
+  def __init__(self, **kwargs):
+    FetchScheduler.__init__(self, **kwargs)
+    self.active_requests = 0
+    self.most_active = 0
+    self.requests_lock = threading.Lock()
+
+  def make_client(self):
+    return FakeClient(self)
+
+
+class FakeClient:
+
+  def __init__(self, scheduler):
+    self.scheduler = scheduler
+    self.connections = {}
+
+  def request(self, uri, method, headers):
+    scheduler = self.scheduler
+    with scheduler.requests_lock:
+      scheduler.active_requests += 1
+      scheduler.most_active = max(scheduler.most_active, scheduler.active_requests)
+    time.sleep(0.01)
+    with scheduler.requests_lock:
+      scheduler.active_requests -= 1
+    parts = uri.split('/')
+    self.connections["%s%s" % (parts[0], parts[2])] = FakeConnection()
+    return (httplib2.Response({'status' : 404}), '')
+
+
+class FakeConnection:
+  sock = None
+
+
+def make_chain_graph(count, **kwargs):
+  # Each person knows the next one
+  g = FakeFetchingGraph(**kwargs)
+  for i in range(1, count + 1):
+    g.set("http://example.com/res/person%s" % i, TestAggregatingGraph.doc_data % (i, i + 1))
+  return g
+
+
 class FakeAggregatingGraph(AggregatingGraph):
   
-  def __init__(self):
+  def __init__(self, store=None):
     self.lookup_counts = {}
     self.graphs = {}
-    AggregatingGraph.__init__(self)
+    AggregatingGraph.__init__(self, store=store)
   
   def lookup(self, uri):
     s = str(uri)
@@ -464,9 +1495,66 @@ class FakeAggregatingGraph(AggregatingGraph):
     self.g += g
 
 
+  def lookup_many(self, uris):
+    for uri in uris:
+      self.lookup(uri)
+
   def receivedLookup(self, uri):
     return (uri in self.lookup_counts)
 
 
+class FakeFetchingGraph(AggregatingGraph):
+
+  def __init__(self, **kwargs):
+    self.bodies = {}
+    self.content_types = {}
+    self.fetches = []
+    self.timeouts = []
+    self.unreachable = False
+    self.largest_read = 0
+    self.not_modified = 0
+    self.delay = 0
+    AggregatingGraph.__init__(self, **kwargs)
+
+  def fetch(self, uri, headers, timeout=None):
+    if self.unreachable:
+      raise socket.error("connection refused")
+    self.fetches.append(uri)
+    self.timeouts.append(timeout)
+    if self.delay > 0 and timeout is not None and timeout < self.delay:
+      time.sleep(timeout)
+      raise socket.timeout("timed out")
+    time.sleep(self.delay)
+    if uri in self.bodies:
+      etag = '"%s"' % hash(self.bodies[uri])
+      if headers.get('if-none-match') == etag:
+        self.not_modified += 1
+        return (httplib2.Response({'status' : 304, 'etag' : etag}), '')
+      return (httplib2.Response({'status' : 200, 'content-type' : 'text/turtle', 'etag' : etag}), self.bodies[uri])
+    return (httplib2.Response({'status' : 404, 'content-type' : 'text/plain'}), '')
+
+  def fetch_stream(self, uri, headers, consume, timeout=None):
+    self.fetches.append(uri)
+    if uri in self.bodies:
+      return consume(httplib2.Response({'status' : 200, 'content-type' : self.content_types[uri]}), FakeStream(self, self.bodies[uri]))
+    return consume(httplib2.Response({'status' : 404, 'content-type' : 'text/plain'}), FakeStream(self, ''))
+
+  def set(self, uri, data, content_type='text/turtle'):
+    self.bodies[uri] = data
+    self.content_types[uri] = content_type
+
+
+class FakeStream(StringIO):
+
+  def __init__(self, graph, data):
+    StringIO.__init__(self, data)
+    self.graph = graph
+
+  def read(self, n=-1):
+    data = StringIO.read(self, n)
+    self.graph.largest_read = max(self.graph.largest_read, len(data))
+    return data
+
+
 if __name__=="__main__":
    unittest.main()